@@ -0,0 +1,165 @@
+import csv
+import glob
+import json
+import multiprocessing.pool
+import numpy
+import os
+import distcache
+import lagrange_log
+
+DEFAULT_REGIONS = 5
+PAIR_FIELDS = [
+    'reference', 'result', 'regions', 'nodes', 'distance',
+    'normalized_distance', 'error'
+]
+NODE_FIELDS = ['reference', 'result', 'node', 'distance', 'error']
+
+
+def read_manifest(path):
+    # Each line names a reference file and a result file, separated by
+    # whitespace or a comma. Relative paths are relative to the manifest.
+    base = os.path.dirname(os.path.abspath(path))
+    pairs = []
+    with open(path) as manifest:
+        for line in manifest:
+            line = line.split('#', 1)[0].strip()
+            if len(line) == 0:
+                continue
+            fields = line.replace(',', ' ').split()
+            if len(fields) != 2:
+                raise RuntimeError(
+                    "Manifest lines should name two files: {}".format(line))
+            pairs.append((os.path.join(base, fields[0]),
+                          os.path.join(base, fields[1])))
+    return pairs
+
+
+def glob_pairs(pattern, reference_root, root='.'):
+    # Pairs every result matching the pattern under root with the file at
+    # the same relative path under reference_root.
+    pairs = []
+    for path in sorted(glob.glob(os.path.join(root, pattern),
+                                 recursive=True)):
+        relpath = os.path.relpath(path, root)
+        pairs.append((os.path.join(reference_root, relpath), path))
+    return pairs
+
+
+def load_log(path, regions=None):
+    with open(path) as infile:
+        return lagrange_log.jsonlog(infile, regions)
+
+
+def resolve_regions(json1, json2, regions=None):
+    if json1.regions is not None and json2.regions is not None and\
+            json1.regions != json2.regions:
+        raise RuntimeError("The two lagrange runs should have the same " +
+                           "number of regions to compute the distance")
+    for r in [json1.regions, json2.regions, regions]:
+        if r is not None:
+            return r
+    return DEFAULT_REGIONS
+
+
+def compare_pair(pair, method=None, regions=None, cache=None):
+    reference, result = pair
+    try:
+        json1 = load_log(reference, regions)
+        json2 = load_log(result, regions)
+        pair_regions = resolve_regions(json1, json2, regions)
+        nodes = json1 & json2
+        dists = distcache.cached_normalized_dist(
+            json1.distribution_matrix(nodes, pair_regions),
+            json2.distribution_matrix(nodes, pair_regions), method, cache)
+    except Exception as e:
+        return {'reference': reference, 'result': result, 'error': str(e)}
+
+    total = float(numpy.sum(dists))
+    taxa = json1.taxa if json1.taxa is not None else json2.taxa
+    return {
+        'reference': reference,
+        'result': result,
+        'regions': pair_regions,
+        'nodes': nodes.tolist(),
+        'node_distances': dists.tolist(),
+        'distance': total,
+        'normalized_distance': total / (taxa - 1) if taxa else None,
+        'error': None,
+    }
+
+
+def _compare_pair_star(args):
+    return compare_pair(*args)
+
+
+def compare_pairs(pairs, method=None, regions=None, procs=1, cache=None):
+    tasks = [(pair, method, regions, cache) for pair in pairs]
+    if procs is None or procs == 1:
+        for task in tasks:
+            yield _compare_pair_star(task)
+        return
+    with multiprocessing.pool.Pool(procs) as pool:
+        for record in pool.imap(_compare_pair_star, tasks):
+            yield record
+
+
+def pair_rows(record):
+    row = {k: record.get(k) for k in PAIR_FIELDS}
+    if record['error'] is None:
+        row['nodes'] = len(record['nodes'])
+    return [row]
+
+
+def node_rows(record):
+    if record['error'] is not None:
+        return [{k: record.get(k) for k in NODE_FIELDS}]
+    return [{
+        'reference': record['reference'],
+        'result': record['result'],
+        'node': node,
+        'distance': dist,
+        'error': None,
+    } for node, dist in zip(record['nodes'], record['node_distances'])]
+
+
+class csv_writer:
+    def __init__(self, outfile, fields):
+        self._writer = csv.DictWriter(outfile, fieldnames=fields)
+        self._writer.writeheader()
+        self._outfile = outfile
+
+    def write(self, row):
+        self._writer.writerow(row)
+        self._outfile.flush()
+
+
+class jsonl_writer:
+    def __init__(self, outfile, fields):
+        self._outfile = outfile
+
+    def write(self, row):
+        self._outfile.write(json.dumps(row) + '\n')
+        self._outfile.flush()
+
+
+WRITERS = {'csv': csv_writer, 'jsonl': jsonl_writer}
+
+
+def run(pairs,
+        outfile,
+        output_format='csv',
+        per_node=False,
+        method=None,
+        regions=None,
+        procs=1,
+        cache=None):
+    fields = NODE_FIELDS if per_node else PAIR_FIELDS
+    make_rows = node_rows if per_node else pair_rows
+    writer = WRITERS[output_format](outfile, fields)
+    errors = 0
+    for record in compare_pairs(pairs, method, regions, procs, cache):
+        if record['error'] is not None:
+            errors += 1
+        for row in make_rows(record):
+            writer.write(row)
+    return errors
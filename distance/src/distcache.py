@@ -0,0 +1,151 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import numpy
+import scipy.sparse
+import graph
+
+CACHE_VERSION = 1
+DEFAULT_CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME',
+                   os.path.join(os.path.expanduser('~'), '.cache')),
+    'lagrange_tools')
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+CACHE_FILENAME = 'distances.sqlite'
+
+
+class distance_cache:
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES):
+        self._path = os.path.abspath(path)
+        self._max_bytes = max_bytes
+        self._local = threading.local()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def max_bytes(self):
+        return self._max_bytes
+
+    def _connect(self):
+        # sqlite connections can not be shared with forked workers or other
+        # threads, so each thread of each process opens its own.
+        local = self._local
+        if getattr(local, 'connection', None) is None or\
+                local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            local.connection = sqlite3.connect(self._path, timeout=60)
+            local.connection.execute(
+                "CREATE TABLE IF NOT EXISTS distances (key TEXT PRIMARY KEY, "
+                + "value BLOB, size INTEGER, last_used REAL)")
+            local.connection.execute(
+                "CREATE INDEX IF NOT EXISTS distances_last_used ON " +
+                "distances (last_used)")
+            local.pid = os.getpid()
+        return local.connection
+
+    def get(self, key):
+        connection = self._connect()
+        with connection:
+            row = connection.execute(
+                "SELECT value FROM distances WHERE key = ?",
+                (key, )).fetchone()
+            if row is None:
+                return None
+            connection.execute(
+                "UPDATE distances SET last_used = ? WHERE key = ?",
+                (time.time(), key))
+        return numpy.frombuffer(row[0], dtype=numpy.float64).copy()
+
+    def put(self, key, dists):
+        value = numpy.ascontiguousarray(dists, dtype=numpy.float64).tobytes()
+        connection = self._connect()
+        with connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO distances VALUES (?, ?, ?, ?)",
+                (key, value, len(value), time.time()))
+            self._evict(connection)
+
+    def _evict(self, connection):
+        total = connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM distances").fetchone()[0]
+        if total <= self._max_bytes:
+            return
+        stale = []
+        for key, size in connection.execute(
+                "SELECT key, size FROM distances ORDER BY last_used"):
+            if total <= self._max_bytes:
+                break
+            stale.append((key, ))
+            total -= size
+        connection.executemany("DELETE FROM distances WHERE key = ?", stale)
+
+
+_cache = None
+
+
+def configure(cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+    global _cache
+    if cache_dir is None:
+        _cache = None
+    else:
+        _cache = distance_cache(os.path.join(cache_dir, CACHE_FILENAME),
+                                max_bytes)
+    return _cache
+
+
+def get_cache():
+    return _cache
+
+
+def matrix_digest(dist_mat):
+    m = hashlib.sha256()
+    if scipy.sparse.issparse(dist_mat):
+        dist_mat = scipy.sparse.csr_matrix(dist_mat, dtype=numpy.float64)
+        dist_mat.sum_duplicates()
+        m.update(b'csr')
+        m.update(numpy.array(dist_mat.shape, dtype=numpy.int64).tobytes())
+        m.update(dist_mat.indptr.astype(numpy.int64).tobytes())
+        m.update(dist_mat.indices.astype(numpy.int64).tobytes())
+        m.update(dist_mat.data.tobytes())
+    else:
+        dist_mat = numpy.ascontiguousarray(dist_mat, dtype=numpy.float64)
+        m.update(b'dense')
+        m.update(numpy.array(dist_mat.shape, dtype=numpy.int64).tobytes())
+        m.update(dist_mat.tobytes())
+    return m.hexdigest()
+
+
+def pair_key(dists1, dists2, method=None):
+    regions = dists1.shape[-1].bit_length() - 1
+    m = hashlib.sha256()
+    m.update("{}:{}:{}:{}".format(CACHE_VERSION,
+                                  graph.select_method(method, regions),
+                                  matrix_digest(dists1),
+                                  matrix_digest(dists2)).encode('utf-8'))
+    return m.hexdigest()
+
+
+def cached_normalized_dist(dists1, dists2, method=None, cache=None):
+    if cache is None:
+        cache = _cache
+    if cache is None:
+        return graph.batch_normalized_dist(dists1, dists2, method)
+    key = pair_key(dists1, dists2, method)
+    dists = cache.get(key)
+    if dists is None:
+        dists = graph.batch_normalized_dist(dists1, dists2, method)
+        cache.put(key, dists)
+    return dists
@@ -1,48 +1,369 @@
+import functools
 import numpy
-import scipy.optimize
+import scipy.sparse
 from numpy.random import default_rng
 
+FLOW_EPSILON = 1e-12
+METHODS = ['hypercube', 'support', 'linprog']
+LINPROG_BATCH_SIZE = 64
+SUPPORT_MIN_REGIONS = 7
 
-def popcount(x):
-    return bin(x).count('1')
 
+def _linprog(*args, **kwargs):
+    # scipy.optimize takes a while to import and most distances never reach
+    # an LP solver, so it is only loaded when one is needed.
+    import scipy.optimize
+    return scipy.optimize.linprog(*args, **kwargs)
 
-class edge:
-    def __init__(self, f, t):
-        self._from = f
-        self._to = t
+
+def _check_linprog(ret):
+    if not ret.success:
+        raise RuntimeError("Failed to solve the flow problem: {}".format(
+            ret.message))
+
+
+class hypercube:
+    def __init__(self, regions):
+        self._regions = regions
+        self._states = 2**regions
+        from_states = numpy.repeat(numpy.arange(self._states), regions)
+        to_states = from_states ^ numpy.tile(1 << numpy.arange(regions),
+                                             self._states)
+        self._from = from_states
+        self._to = to_states
+        self._A_eq = self._make_incidence_matrix()
+
+    def _make_incidence_matrix(self):
+        edges = numpy.arange(self.edge_count)
+        rows = numpy.concatenate([self._from, self._to])
+        cols = numpy.concatenate([edges, edges])
+        vals = numpy.concatenate(
+            [-numpy.ones(self.edge_count),
+             numpy.ones(self.edge_count)])
+        # The row of the last state is implied by the others, so it is left
+        # out of the equality constraints.
+        keep = rows < self._states - 1
+        return scipy.sparse.csr_matrix(
+            (vals[keep], (rows[keep], cols[keep])),
+            shape=(self._states - 1, self.edge_count))
+
+    @property
+    def edge_count(self):
+        return len(self._from)
+
+    @property
+    def incidence_matrix(self):
+        return self._A_eq
+
+
+@functools.lru_cache(maxsize=None)
+def get_hypercube(regions):
+    return hypercube(regions)
+
+
+class linprog_solver:
+    def __init__(self, regions):
+        self._graph = get_hypercube(regions)
+        self._c = numpy.ones(self._graph.edge_count)
+
+    def solve(self, b_eq):
+        ret = _linprog(self._c,
+                       A_eq=self._graph.incidence_matrix,
+                       b_eq=b_eq,
+                       method='highs')
+        _check_linprog(ret)
+        return numpy.sum(ret.x)
+
+    def solve_batch(self, b_eqs):
+        # Independent problems are stacked into one block diagonal LP, in
+        # chunks so a single solve stays a reasonable size.
+        dists = numpy.zeros(len(b_eqs))
+        for start in range(0, len(b_eqs), LINPROG_BATCH_SIZE):
+            chunk = b_eqs[start:start + LINPROG_BATCH_SIZE]
+            A_eq = scipy.sparse.kron(scipy.sparse.identity(len(chunk)),
+                                     self._graph.incidence_matrix,
+                                     format='csr')
+            c = numpy.ones(len(chunk) * self._graph.edge_count)
+            ret = _linprog(c,
+                           A_eq=A_eq,
+                           b_eq=numpy.ravel(chunk),
+                           method='highs')
+            _check_linprog(ret)
+            flows = numpy.reshape(ret.x, (len(chunk), -1))
+            dists[start:start + len(chunk)] = numpy.sum(flows, axis=1)
+        return dists
+
+
+@functools.lru_cache(maxsize=None)
+def get_linprog_solver(regions):
+    return linprog_solver(regions)
+
+
+class hypercube_flow:
+    # Exact uncapacitated min cost flow on the region hypercube with unit edge
+    # costs, solved with the primal-dual method. Because every cost is +-1 the
+    # potentials stay integral, so an arc is admissible exactly when the
+    # potentials of its endpoints differ by one, and each phase raises the
+    # shortest augmenting path length by at least one. This bounds the number
+    # of phases by the number of regions.
+    def __init__(self, supply, regions):
+        self._regions = regions
+        self._states = len(supply)
+        self._excess = [0.0] * self._states
+        self._deficit = [0.0] * self._states
+        for s, v in enumerate(supply):
+            if v > FLOW_EPSILON:
+                self._excess[s] = float(v)
+            elif v < -FLOW_EPSILON:
+                self._deficit[s] = -float(v)
+        self._flow = [[0.0] * regions for _ in range(self._states)]
+        self._potential = [0] * self._states
+
+    def _unbalanced(self):
+        return any(e > FLOW_EPSILON for e in self._excess) and\
+                any(d > FLOW_EPSILON for d in self._deficit)
+
+    def _update_potentials(self):
+        states = numpy.arange(self._states)
+        flow = numpy.array(self._flow).reshape(self._states, self._regions)
+        potential = numpy.array(self._potential)
+        dist = numpy.where(numpy.array(self._excess) > FLOW_EPSILON, 0.0,
+                           numpy.inf)
+        while True:
+            new_dist = dist.copy()
+            for b in range(self._regions):
+                pred = states ^ (1 << b)
+                # Moving mass from pred to a state either cancels flow that
+                # already runs the other way, or adds flow at unit cost.
+                cost = numpy.where(flow[:, b] > FLOW_EPSILON, -1, 1)
+                reduced = cost + potential[pred] - potential
+                new_dist = numpy.minimum(new_dist, dist[pred] + reduced)
+            if numpy.array_equal(new_dist, dist):
+                break
+            dist = new_dist
+        deficit = numpy.array(self._deficit) > FLOW_EPSILON
+        shortest = numpy.min(dist[deficit])
+        if numpy.isinf(shortest):
+            raise RuntimeError(
+                "The flow problem on the hypercube is infeasible")
+        self._potential = (potential +
+                           numpy.minimum(dist, shortest)).astype(int).tolist()
+
+    def _capacity(self, u, b, v):
+        if self._potential[v] == self._potential[u] + 1:
+            return numpy.inf
+        if self._potential[v] == self._potential[u] - 1:
+            return self._flow[v][b]
+        return 0.0
+
+    def _push(self, u, b, v, amount):
+        if self._potential[v] == self._potential[u] + 1:
+            self._flow[u][b] += amount
+        else:
+            self._flow[v][b] = max(self._flow[v][b] - amount, 0.0)
+
+    def _compute_levels(self):
+        level = [-1] * self._states
+        queue = [s for s in range(self._states)
+                 if self._excess[s] > FLOW_EPSILON]
+        for s in queue:
+            level[s] = 0
+        reached_sink = False
+        for u in queue:
+            if self._deficit[u] > FLOW_EPSILON:
+                reached_sink = True
+            for b in range(self._regions):
+                v = u ^ (1 << b)
+                if level[v] != -1:
+                    continue
+                if self._capacity(u, b, v) > FLOW_EPSILON:
+                    level[v] = level[u] + 1
+                    queue.append(v)
+        return level, reached_sink
+
+    def _augment(self, u, limit, level, arc):
+        if self._deficit[u] > FLOW_EPSILON:
+            amount = min(limit, self._deficit[u])
+            self._deficit[u] -= amount
+            return amount
+        while arc[u] < self._regions:
+            b = arc[u]
+            v = u ^ (1 << b)
+            if level[v] == level[u] + 1:
+                cap = self._capacity(u, b, v)
+                if cap > FLOW_EPSILON:
+                    pushed = self._augment(v, min(limit, cap), level, arc)
+                    if pushed > FLOW_EPSILON:
+                        self._push(u, b, v, pushed)
+                        return pushed
+            arc[u] += 1
+        return 0.0
+
+    def _blocking_flow(self):
+        while True:
+            level, reached_sink = self._compute_levels()
+            if not reached_sink:
+                return
+            arc = [0] * self._states
+            for s in range(self._states):
+                while self._excess[s] > FLOW_EPSILON:
+                    pushed = self._augment(s, self._excess[s], level, arc)
+                    if pushed <= FLOW_EPSILON:
+                        break
+                    self._excess[s] -= pushed
+
+    def solve(self):
+        while self._unbalanced():
+            self._update_potentials()
+            self._blocking_flow()
+        return sum(sum(f) for f in self._flow)
+
+
+def popcount(x, regions):
+    counts = numpy.zeros(numpy.shape(x), dtype=int)
+    for b in range(regions):
+        counts += (x >> b) & 1
+    return counts
+
+
+def support_dist(states, dist_diff, regions):
+    # Shortest paths on the hypercube are Hamming distances, so the flow
+    # problem reduces to a transport problem between the states that lose
+    # mass and the states that gain it, without touching any other state.
+    last = 2**regions - 1
+    keep = states != last
+    states = numpy.append(states[keep], last)
+    dist_diff = numpy.append(dist_diff[keep], -numpy.sum(dist_diff[keep]))
+    sources = dist_diff > FLOW_EPSILON
+    sinks = dist_diff < -FLOW_EPSILON
+    supply = dist_diff[sources]
+    demand = -dist_diff[sinks]
+    if len(supply) == 0 or len(demand) == 0:
+        return 0.0
+    cost = popcount(states[sources][:, None] ^ states[sinks][None, :],
+                    regions)
+    if len(supply) == 1:
+        return numpy.sum(cost[0] * demand)
+    if len(demand) == 1:
+        return numpy.sum(cost[:, 0] * supply)
+    A_eq = scipy.sparse.vstack([
+        scipy.sparse.kron(scipy.sparse.identity(len(supply)),
+                          numpy.ones((1, len(demand)))),
+        scipy.sparse.kron(numpy.ones((1, len(supply))),
+                          scipy.sparse.identity(len(demand)))
+    ],
+                               format='csr')
+    b_eq = numpy.concatenate([supply, demand])
+    # As in the hypercube LP, one constraint is implied by the others.
+    ret = _linprog(numpy.ravel(cost),
+                   A_eq=A_eq[:-1],
+                   b_eq=b_eq[:-1],
+                   method='highs')
+    if not ret.success:
+        raise RuntimeError("Failed to solve the transport problem: {}".format(
+            ret.message))
+    return ret.fun
+
+
+def support_batch_dist(dist_diffs, regions):
+    dist_diffs = scipy.sparse.csr_matrix(dist_diffs)
+    dists = numpy.zeros(dist_diffs.shape[0])
+    for i in range(dist_diffs.shape[0]):
+        start, end = dist_diffs.indptr[i], dist_diffs.indptr[i + 1]
+        if end > start:
+            dists[i] = support_dist(dist_diffs.indices[start:end],
+                                    dist_diffs.data[start:end], regions)
+    return dists
+
+
+def hypercube_batch_dist(dist_diffs, regions):
+    # The last state has no equality row in the LP, so it absorbs any
+    # difference in total mass between the two distributions.
+    supply = numpy.array(dist_diffs, dtype=float)
+    supply[:, -1] = -numpy.sum(supply[:, :-1], axis=1)
+    dists = numpy.zeros(len(supply))
+    for i in numpy.flatnonzero(
+            numpy.any(numpy.abs(supply) > FLOW_EPSILON, axis=1)):
+        dists[i] = hypercube_flow(supply[i], regions).solve()
+    return dists
+
+
+def select_method(method, regions):
+    if method is None:
+        if regions >= SUPPORT_MIN_REGIONS:
+            return 'support'
+        return 'hypercube'
+    if method not in METHODS:
+        raise ValueError("Unknown distance method: {}".format(method))
+    return method
+
+
+def as_distribution_matrices(dists1, dists2):
+    if scipy.sparse.issparse(dists1) or scipy.sparse.issparse(dists2):
+        return (scipy.sparse.csr_matrix(dists1, dtype=float),
+                scipy.sparse.csr_matrix(dists2, dtype=float))
+    return (numpy.asarray(dists1, dtype=float),
+            numpy.asarray(dists2, dtype=float))
+
+
+def batch_dist_diff(dist_diffs, method=None):
+    regions = dist_diffs.shape[1].bit_length() - 1
+    method = select_method(method, regions)
+    if dist_diffs.shape[0] == 0:
+        return numpy.zeros(0)
+    if method == 'support':
+        return support_batch_dist(dist_diffs, regions)
+    if scipy.sparse.issparse(dist_diffs):
+        dist_diffs = dist_diffs.toarray()
+    if method == 'linprog':
+        return get_linprog_solver(regions).solve_batch(dist_diffs[:, :-1])
+    return hypercube_batch_dist(dist_diffs, regions)
+
+
+def batch_dist(dists1, dists2, method=None):
+    dists1, dists2 = as_distribution_matrices(dists1, dists2)
+    return batch_dist_diff(dists1 - dists2, method)
+
+
+def batch_normalized_dist(dists1, dists2, method=None):
+    dists1, dists2 = as_distribution_matrices(dists1, dists2)
+    regions = dists1.shape[-1].bit_length() - 1
+    return batch_dist_diff(dists1 - dists2, method) / regions
+
+
+def batch_dist_upper_bound(dists1, dists2):
+    # Every unit of mass that has to move travels at most one edge per
+    # region, which bounds the exact distance.
+    dists1, dists2 = as_distribution_matrices(dists1, dists2)
+    regions = dists1.shape[-1].bit_length() - 1
+    dist_diffs = (dists1 - dists2)[:, :-1]
+    moved = (numpy.ravel(abs(dist_diffs).sum(axis=1)) +
+             numpy.abs(numpy.ravel(dist_diffs.sum(axis=1)))) / 2
+    return regions * moved
+
+
+def batch_normalized_dist_upper_bound(dists1, dists2):
+    dists1, dists2 = as_distribution_matrices(dists1, dists2)
+    regions = dists1.shape[-1].bit_length() - 1
+    return batch_dist_upper_bound(dists1, dists2) / regions
 
 
 class problem:
-    def __init__(self, dist_diff):
-        self._edges = []
-        self._states = len(dist_diff)
+    def __init__(self, dist_diff, method=None):
+        if scipy.sparse.issparse(dist_diff):
+            self._dist_diff = scipy.sparse.csr_matrix(dist_diff, dtype=float)
+        else:
+            self._dist_diff = numpy.reshape(
+                numpy.asarray(dist_diff, dtype=float), (1, -1))
+        self._states = self._dist_diff.shape[1]
         self._regions = self._states.bit_length() - 1
-        self._b_eq = dist_diff[:-1]
-        for i in range(self._states):
-            for j in range(self._states):
-                if popcount(i ^ j) == 1:
-                    self._edges.append(edge(i, j))
+        self._method = select_method(method, self._regions)
 
     def make_matrix(self):
-        matrix = []
-        for state in range(self._states-1):
-            row = []
-            for e in self._edges:
-                if e._from == state:
-                    row.append(-1.0)
-                elif e._to == state:
-                    row.append(1.0)
-                else:
-                    row.append(0.0)
-            matrix.append(row)
-        return numpy.array(matrix)
+        return get_hypercube(self._regions).incidence_matrix
 
     def dist(self):
-        A_eq = self.make_matrix()
-        c = numpy.ones(len(self._edges))
-        ret = scipy.optimize.linprog(c, A_eq=A_eq, b_eq=self._b_eq)
-        return numpy.sum(ret.x)
+        return batch_dist_diff(self._dist_diff, self._method)[0]
 
     def normalized_dist(self):
         return self.dist()/self._regions
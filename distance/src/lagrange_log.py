@@ -1,36 +1,119 @@
-import json
+import array
+import jsonstream
 import numpy
+import scipy.sparse
+
+
+NODE_RESULTS_KEY = 'node-results'
+ATTRIBUTES_KEY = 'attributes'
+
+
+class NodeResults:
+    def __init__(self):
+        self._numbers = array.array('q')
+        self._nodes = array.array('q')
+        self._states = array.array('q')
+        self._ratios = array.array('d')
+
+    def add(self, obj):
+        for s in obj['states']:
+            self._nodes.append(len(self._numbers))
+            self._states.append(s['distribution'])
+            self._ratios.append(s['ratio'])
+        self._numbers.append(obj['number'])
+
+    def indexes(self):
+        return numpy.sort(numpy.frombuffer(self._numbers, dtype=numpy.int64))
+
+    def max_state(self):
+        return int(
+            numpy.max(numpy.frombuffer(self._states, dtype=numpy.int64),
+                      initial=0))
+
+    def distribution_matrix(self, indexes, regions):
+        numbers = numpy.frombuffer(self._numbers, dtype=numpy.int64)
+        rows = numpy.searchsorted(indexes, numbers)
+        return scipy.sparse.csr_matrix(
+            (numpy.frombuffer(self._ratios, dtype=numpy.float64),
+             (rows[numpy.frombuffer(self._nodes, dtype=numpy.int64)],
+              numpy.frombuffer(self._states, dtype=numpy.int64))),
+            shape=(len(indexes), 2**regions))
 
 
 class jsonlog:
-    def __init__(self, logfile):
-        self._log = json.load(logfile)
-        self._setup()
+    # Reads either a bare list of node results, or a full lagrange results
+    # file, in which case the region and taxa counts come from its
+    # attributes.
+    def __init__(self, logfile, regions=None):
+        self._regions = regions
+        self._taxa = None
+        self._setup(logfile)
 
-    def _setup_index_map(self):
-        self._indexes = []
-        for obj in self._log:
-            self._indexes.append(obj['number'])
+    def _read_node_results(self, stream):
+        node_results = NodeResults()
+        for obj in stream.iter_array():
+            node_results.add(obj)
+        return node_results
 
-        self._indexes = sorted(self._indexes)
+    def _read_results_file(self, stream):
+        node_results = NodeResults()
+        for key in stream.iter_object():
+            if key == NODE_RESULTS_KEY:
+                node_results = self._read_node_results(stream)
+            elif key == ATTRIBUTES_KEY:
+                attributes = stream.decode_value()
+                self._regions = attributes['regions']
+                self._taxa = attributes['taxa']
+            else:
+                stream.skip_value()
+        return node_results
 
-        self._index_json_map = {}
-        for obj in self._log:
-            self._index_json_map[obj['number']] = obj
+    def _setup_distributions(self, node_results):
+        self._indexes = node_results.indexes()
+        regions = self._regions
+        if regions is None:
+            regions = node_results.max_state().bit_length()
+        self._distributions = node_results.distribution_matrix(
+            self._indexes, regions)
 
-    def _setup(self):
-        self._setup_index_map()
+    def _setup(self, logfile):
+        stream = jsonstream.JSONStream(logfile)
+        if stream.peek() == '{':
+            node_results = self._read_results_file(stream)
+        else:
+            node_results = self._read_node_results(stream)
+        self._setup_distributions(node_results)
+
+    @property
+    def regions(self):
+        return self._regions
+
+    @property
+    def taxa(self):
+        return self._taxa
 
     def distribution_vector(self, index, regions):
-        obj = self._index_json_map[index]
-        dist_vec = numpy.zeros(2**regions)
-        for s in obj['states']:
-            dist_vec[s['distribution']] = s['ratio']
+        return self.distribution_matrix([index], regions)
 
-        return dist_vec
+    def distribution_matrix(self, indexes, regions):
+        rows = numpy.searchsorted(self._indexes, indexes)
+        return FitStates(self._distributions[rows], regions)
 
     def __and__(self, other):
-        return sorted(set(self._indexes) & set(other._indexes))
+        return numpy.intersect1d(self._indexes, other._indexes)
+
+
+def FitStates(dist_mat, regions):
+    states = 2**regions
+    if dist_mat.shape[1] == states:
+        return dist_mat
+    if dist_mat.shape[1] > states:
+        raise RuntimeError(
+            "The distributions have more states than {} regions allow".format(
+                regions))
+    return scipy.sparse.csr_matrix(
+        (dist_mat.data, dist_mat.indices, dist_mat.indptr),
+        shape=(dist_mat.shape[0], states))
 
 
 def DistributionVectorGenerator(json1, json2, regions):
@@ -39,3 +122,9 @@ def DistributionVectorGenerator(json1, json2, regions):
         d1 = json1.distribution_vector(i, regions)
         d2 = json2.distribution_vector(i, regions)
         yield (d1, d2)
+
+
+def DistributionMatrices(json1, json2, regions):
+    inds = json1 & json2
+    return (json1.distribution_matrix(inds, regions),
+            json2.distribution_matrix(inds, regions))
@@ -1,22 +1,95 @@
 #!/usr/bin/env python3
 
 import argparse
+import os
+import sys
 import lagrange_log
 import graph
+import batch
+import distcache
 
 parser = argparse.ArgumentParser()
 
-parser.add_argument("jsons", type=str, nargs="+")
+parser.add_argument("jsons", type=str, nargs="*")
+parser.add_argument("--method",
+                    type=str,
+                    choices=graph.METHODS,
+                    default=None)
+parser.add_argument("--regions",
+                    type=int,
+                    help="Region count for files that do not record it " +
+                    "(default: {})".format(batch.DEFAULT_REGIONS))
+parser.add_argument("--manifest",
+                    type=str,
+                    help="File listing reference and result file pairs")
+parser.add_argument("--glob",
+                    type=str,
+                    help="Pattern of result files, relative to --root")
+parser.add_argument("--root", type=str, default='.')
+parser.add_argument("--reference-root",
+                    type=str,
+                    help="Directory holding the reference file for each " +
+                    "--glob match at the same relative path")
+parser.add_argument("--output", type=str)
+parser.add_argument("--format",
+                    type=str,
+                    choices=list(batch.WRITERS),
+                    default=None)
+parser.add_argument("--per-node", action='store_true', default=False)
+parser.add_argument("--procs", type=int, default=1)
+parser.add_argument("--cache-dir",
+                    type=str,
+                    default=distcache.DEFAULT_CACHE_DIR)
+parser.add_argument("--cache-size",
+                    type=int,
+                    default=distcache.DEFAULT_MAX_BYTES // (1024 * 1024),
+                    help="Size of the distance cache in MiB")
+parser.add_argument("--no-cache", action='store_true', default=False)
 
 args = parser.parse_args()
 
-with open(args.jsons[0]) as infile:
-    json1 = lagrange_log.jsonlog(infile)
+cache = None
+if not args.no_cache:
+    cache = distcache.configure(args.cache_dir, args.cache_size * 1024 * 1024)
 
-with open(args.jsons[1]) as infile:
-    json2 = lagrange_log.jsonlog(infile)
+if args.manifest is None and args.glob is None:
+    if len(args.jsons) < 2:
+        parser.error("Please give two result files, --manifest or --glob")
 
-for d1, d2 in lagrange_log.DistributionVectorGenerator(json1, json2, 5):
-    d = d1-d2
-    p = graph.problem(d)
-    print(p.normalized_dist())
+    with open(args.jsons[0]) as infile:
+        json1 = lagrange_log.jsonlog(infile, args.regions)
+
+    with open(args.jsons[1]) as infile:
+        json2 = lagrange_log.jsonlog(infile, args.regions)
+
+    regions = batch.resolve_regions(json1, json2, args.regions)
+    d1, d2 = lagrange_log.DistributionMatrices(json1, json2, regions)
+    for d in distcache.cached_normalized_dist(d1, d2, args.method):
+        print(d)
+    sys.exit(0)
+
+pairs = []
+if args.manifest is not None:
+    pairs.extend(batch.read_manifest(args.manifest))
+if args.glob is not None:
+    if args.reference_root is None:
+        parser.error("--glob needs --reference-root")
+    pairs.extend(batch.glob_pairs(args.glob, args.reference_root, args.root))
+
+output_format = args.format
+if output_format is None:
+    output_format = 'jsonl' if args.output is not None and\
+            os.path.splitext(args.output)[1] == '.jsonl' else 'csv'
+
+if args.output is None:
+    errors = batch.run(pairs, sys.stdout, output_format, args.per_node,
+                       args.method, args.regions, args.procs, cache)
+else:
+    with open(args.output, 'w', newline='') as outfile:
+        errors = batch.run(pairs, outfile, output_format, args.per_node,
+                           args.method, args.regions, args.procs, cache)
+
+if errors != 0:
+    print("{} of {} pairs could not be compared".format(errors, len(pairs)),
+          file=sys.stderr)
+    sys.exit(1)
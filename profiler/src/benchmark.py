@@ -1,6 +1,5 @@
 #!/usr/bin/env python3
 import dataset
-import plots
 import program
 import experiment
 import util
@@ -12,16 +11,40 @@ import rich
 import rich.progress
 import yaml
 import subprocess
-import flamegraph
-import pandas
-import seaborn
-import matplotlib
 import hashlib
 import datetime
-
-
-def make_datasets(taxa_count, length, ds_count, workers, approximate,
-                  threads_per_worker, root):
+import contextlib
+import multiprocessing.pool
+import numpy
+
+
+def make_datasets(taxa_count,
+                  length,
+                  ds_count,
+                  workers,
+                  approximate,
+                  threads_per_worker,
+                  root,
+                  seed=None,
+                  pool=None,
+                  validate=False):
+    # Each dataset gets its own stream spawned from seed, so the datasets
+    # are the same whether or not they are made on the pool. Datasets that
+    # are already on disk are loaded instead.
+    if seed is None:
+        seed = numpy.random.SeedSequence()
+    prefixes = list(util.base58_generator(ds_count))
+    seeds = seed.spawn(ds_count)
+    new = [
+        index for index, prefix in enumerate(prefixes)
+        if not os.path.exists(os.path.join(root, prefix))
+    ]
+    tasks = [(taxa_count, length, seeds[index], validate) for index in new]
+    if pool is not None:
+        made = pool.starmap(dataset.generate_lagrange_data, tasks)
+    else:
+        made = [dataset.generate_lagrange_data(*task) for task in tasks]
+    data = dict(zip(new, made))
     return [
         dataset.lagrange_dataset(prefix,
                                  root,
@@ -29,11 +52,20 @@ def make_datasets(taxa_count, length, ds_count, workers, approximate,
                                  length=length,
                                  workers=workers,
                                  approximate=approximate,
-                                 threads_per_worker=threads_per_worker)
-        for prefix in util.base58_generator(ds_count)
+                                 threads_per_worker=threads_per_worker,
+                                 seed=seeds[index],
+                                 data=data.get(index),
+                                 validate=validate)
+        for index, prefix in enumerate(prefixes)
     ]
 
 
+def make_pool(procs):
+    if procs is None or procs == 1:
+        return contextlib.nullcontext()
+    return multiprocessing.pool.Pool(procs)
+
+
 def compute_hash_with_path(path):
     with open(path, 'rb') as program_file:
         m = hashlib.sha256()
@@ -47,13 +79,30 @@ def load_parameters(prefix):
         return yaml.load(yamlfile.read())
 
 
-def run(prefix, regions, taxa, iters, procs, program_path, profile,
-        approximate, enable_redo, threading_configurations, flamegraph_cmd):
+def run(prefix,
+        regions,
+        taxa,
+        iters,
+        procs,
+        program_path,
+        profile,
+        approximate,
+        enable_redo,
+        threading_configurations,
+        flamegraph_cmd,
+        timeout=None,
+        memory_limit=None,
+        seed=None,
+        validate_trees=False):
     os.makedirs(prefix, exist_ok=True)
+    # The entropy is recorded, so the datasets of a run can be made again.
+    seed = numpy.random.SeedSequence(seed)
 
     exp_program = [
         program.lagrange(binary_path=os.path.abspath(program_path),
-                         profile=profile)
+                         profile=profile,
+                         timeout=timeout,
+                         memory_limit=memory_limit)
     ]
 
     exp = []
@@ -85,6 +134,7 @@ def run(prefix, regions, taxa, iters, procs, program_path, profile,
                         'profile': profile,
                         'approximate': approximate,
                         'threading_configurations': threading_configurations,
+                        'seed': seed.entropy,
                     },
                     explicit_start=True,
                     explicit_end=True))
@@ -93,21 +143,26 @@ def run(prefix, regions, taxa, iters, procs, program_path, profile,
             notesfile.write("- Started on: {}\n".format(
                 datetime.datetime.now().isoformat()))
 
-        for r, t, tc in itertools.product(regions, taxa,
-                                          threading_configurations):
-            exp_path = os.path.join(
-                prefix,
-                exp_name_format.format(regions=r,
-                                       taxa=t,
-                                       workers=tc[0],
-                                       tpw=tc[1]))
-            full_path = os.path.join(os.getcwd(), exp_path)
-            exp.append(
-                experiment.experiment(
-                    exp_path,
-                    make_datasets(t, r, iters, tc[0], approximate, tc[1],
-                                  full_path), exp_program))
-            progress_bar.update(make_task, advance=1.0)
+        configurations = list(
+            itertools.product(regions, taxa, threading_configurations))
+        with make_pool(procs) as pool:
+            for (r, t, tc), exp_seed in zip(configurations,
+                                            seed.spawn(len(configurations))):
+                exp_path = os.path.join(
+                    prefix,
+                    exp_name_format.format(regions=r,
+                                           taxa=t,
+                                           workers=tc[0],
+                                           tpw=tc[1]))
+                full_path = os.path.join(os.getcwd(), exp_path)
+                exp.append(
+                    experiment.experiment(
+                        exp_path,
+                        make_datasets(t, r, iters, tc[0], approximate, tc[1],
+                                      full_path, exp_seed, pool,
+                                      validate_trees),
+                        exp_program))
+                progress_bar.update(make_task, advance=1.0)
 
         rich.print("Running {} experiments".format(len(exp)))
 
@@ -132,10 +187,15 @@ def run(prefix, regions, taxa, iters, procs, program_path, profile,
                 for result in results:
                     writer.writerow(result.write_row())
 
+            # The plotting libraries take seconds to import, so they are
+            # only loaded once there is something to plot.
+            import pandas
+            import plots
             dataframe = pandas.read_csv(os.path.join(prefix, 'results.csv'))
             plots.make_plots(dataframe, prefix)
 
         else:
+            import flamegraph
             fg_work = len(exp) * len(exp[0].datasets)
             fg_task = progress_bar.add_task("Making Flamegraphs...",
                                             total=fg_work)
@@ -1,11 +1,35 @@
 #!/usr/bin/env python3
 
 import os
+import re
 import numpy
-import ete3
 import util
 import base58
 import shutil
+import treegen
+
+# Leaf names follow an opening parenthesis or a comma. Inner nodes are not
+# named in the trees written here.
+LEAF_NAME_PATTERN = re.compile(r'[(,]([^(),:;]+)')
+
+
+def generate_lagrange_data(taxa_count, length, seed, validate=False):
+    # Makes the tree and alignment of a dataset from its own random stream,
+    # so datasets come out the same whichever process makes them, and in
+    # whatever order. Only strings are returned, which are cheap to send
+    # back from a worker process.
+    rng = numpy.random.default_rng(seed)
+    tree = treegen.generate(list(util.base26_generator(taxa_count)), rng)
+    tree.make_ultrametric()
+    newick = tree.newick()
+    if validate:
+        treegen.validate(newick, tree.names)
+    return {
+        'newick': newick,
+        'taxa': tree.names,
+        'alignment': lagrange_dataset.generate_alignment(
+            tree.names, length, rng),
+    }
 
 
 class dataset:
@@ -85,6 +109,10 @@ threads-per-worker = {threads_per_worker}
         Keyword arguments:
         length      -- Number of regions to generate
         taxa_count  -- Number of taxa to generate
+        seed        -- numpy SeedSequence for the random stream of the dataset
+        data        -- Output of generate_lagrange_data, if it was already
+                       made for this dataset
+        validate    -- Check generated trees with ete3
         """
         super().__init__(path, root, **kwargs)
 
@@ -96,6 +124,13 @@ threads-per-worker = {threads_per_worker}
             self._approximate = kwargs['approximate']
         else:
             self._approximate = False
+        self._seed = kwargs.get('seed')
+        self._validate = kwargs.get('validate', False)
+        if self._seed is None:
+            self._seed = numpy.random.SeedSequence()
+        self._area_names = [
+            "R" + str.upper(s) for s in util.base26_generator(self.length)
+        ]
 
         if os.path.exists(self.full_path):
             self._existing = True
@@ -106,28 +141,34 @@ threads-per-worker = {threads_per_worker}
                     break
             self._path = os.path.join(self._root, self._path)
             self._lock_paths()
-            self._tree = ete3.Tree(
-                open(os.path.join(self.full_path, self.tree_path)).read())
+            self._newick = open(os.path.join(self.full_path,
+                                             self.tree_path)).read()
+            self._taxa = LEAF_NAME_PATTERN.findall(self._newick)
             return
         else:
             self._file_prefix = self._file_prefix + "_" + util.make_random_nonce(
             )
-            self._generate()
+            if kwargs.get('data') is not None:
+                self._set_data(kwargs['data'])
+            else:
+                self._generate()
             self._existing = False
 
+    def _set_data(self, data):
+        self._newick = data['newick']
+        self._taxa = data['taxa']
+        self._alignment = data['alignment']
+
     def _generate(self):
-        self._tree = ete3.Tree()
-        self._tree.populate(
-            self._taxa_count,
-            names_library=[s for s in util.base26_generator(self._taxa_count)])
-        for c in self._tree.traverse():
-            c.dist = numpy.random.gamma(0.5)
-        self._make_ultrametric(self._tree)
-        self._alignment = lagrange_dataset.generate_alignment(
-            self.taxa_set, self._length)
-        self._area_names = [
-            "R" + str.upper(s) for s in util.base26_generator(self.length)
-        ]
+        self._set_data(
+            generate_lagrange_data(self._taxa_count, self._length,
+                                   self._seed, self._validate))
+
+    def regenerate(self):
+        # A dataset is redone with a new stream, spawned from its own so the
+        # redo is reproducible too.
+        self._seed = self._seed.spawn(1)[0]
+        self._generate()
 
     def remove(self):
         shutil.rmtree(self.full_path)
@@ -163,20 +204,7 @@ threads-per-worker = {threads_per_worker}
 
     def _write_treefile(self):
         with open(self.tree_path, 'w') as outfile:
-            outfile.write(self._tree.write(format=5))
-
-    @staticmethod
-    def _make_ultrametric(tree):
-        heights = [
-            lagrange_dataset._make_ultrametric(c) for c in tree.children
-        ]
-        if len(heights) == 0:
-            return tree.dist
-        max_height = max(heights)
-        for c, h in zip(tree.children, heights):
-            dh = max_height - h
-            c.dist += dh
-        return max_height + tree.dist
+            outfile.write(self._newick)
 
     @property
     def lagrange_config_filename(self):
@@ -212,7 +240,7 @@ threads-per-worker = {threads_per_worker}
 
     @property
     def taxa_set(self):
-        return [n.name for n in self._tree.get_leaves()]
+        return self._taxa
 
     @property
     def alignment(self):
@@ -235,5 +263,10 @@ threads-per-worker = {threads_per_worker}
         return os.path.join(self.path, self.alignment_filename)
 
     @staticmethod
-    def generate_alignment(taxa_set, length):
-        return {t: numpy.random.choice(2, length) for t in taxa_set}
+    def generate_alignment(taxa_set, length, rng):
+        rows = rng.integers(0,
+                            2,
+                            size=(len(taxa_set), length),
+                            dtype=numpy.uint8)
+        rows += ord('0')
+        return {t: row.tobytes().decode() for t, row in zip(taxa_set, rows)}
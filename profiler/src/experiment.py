@@ -1,15 +1,17 @@
 #!/usr/bin/env python3
 
 import util
+import asyncio
 import os
 import dataset
 import program
-import multiprocessing
-import multiprocessing.pool
+import rusage
 import itertools
 import rich.progress
 from rich import print
 
+MAX_REDOS = 3
+
 # The plan is to have a root level class call experiment that handels the
 # deployment and running of the process. There are a few questions:
 #   - How to specify the datasets
@@ -45,14 +47,41 @@ class experiment:
         return self._datasets
 
     @staticmethod
-    def _internal_run(ds, prog, redo_enabled=False):
+    def _internal_run(ds, prog, redo_enabled=False, redos=0):
         ds.write()
         ret = prog.run(ds)
-        if not ret and redo_enabled:
+        if not ret and redo_enabled and redos < MAX_REDOS:
             print("[red]Redoing this run")
             ds.remove()
-            ds._generate()
-            experiment._internal_run(ds, prog, redo_enabled)
+            ds.regenerate()
+            experiment._internal_run(ds, prog, redo_enabled, redos + 1)
+
+    @staticmethod
+    async def _internal_run_async(ds, prog, pool, redo_enabled=False,
+                                  redos=0):
+        await asyncio.to_thread(ds.write)
+        ret = await prog.run_async(ds, pool)
+        if not ret and redo_enabled and redos < MAX_REDOS:
+            print("[red]Redoing this run")
+            await asyncio.to_thread(ds.remove)
+            await asyncio.to_thread(ds.regenerate)
+            await experiment._internal_run_async(ds, prog, pool, redo_enabled,
+                                                 redos + 1)
+
+    async def _run_async(self, jobs, procs, progress_bar, redo_enabled):
+        # The runs are plain processes, so one event loop can wait on all of
+        # them. The progress bar moves as each run finishes.
+        pool = rusage.process_pool(procs)
+        cur_task = progress_bar.add_task("Current Experiment",
+                                         total=len(jobs))
+
+        async def run_job(ds, prog):
+            await experiment._internal_run_async(ds, prog, pool,
+                                                 redo_enabled)
+            progress_bar.update(cur_task, advance=1.0)
+
+        await asyncio.gather(*[run_job(ds, prog) for ds, prog in jobs])
+        progress_bar.update(cur_task, visible=False)
 
     def run(self, procs=None, progress_bar=None, redo_enabled=False):
         jobs = [(ds, prog) for ds in self._datasets for prog in self._programs]
@@ -66,8 +95,8 @@ class experiment:
                 self._internal_run(ds, prog, redo_enabled)
             progress_bar.update(cur_task, visible=False)
         else:
-            with multiprocessing.pool.Pool(procs) as pool:
-                pool.starmap(experiment._internal_run, jobs)
+            asyncio.run(
+                self._run_async(jobs, procs, progress_bar, redo_enabled))
 
     def collect_results(self):
         return [
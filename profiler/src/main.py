@@ -3,7 +3,6 @@
 import argparse
 import itertools
 import benchmark
-import git
 import os
 import datetime
 import util
@@ -57,8 +56,49 @@ if __name__ == "__main__":
     parser.add_argument("--resume", action='store_true', default=False)
     parser.add_argument("--recompute", action='store_true', default=False)
     parser.add_argument("--no-really", action='store_true', default=False)
+    parser.add_argument("--timeout",
+                        type=float,
+                        help="Kill a lagrange run after this many seconds")
+    parser.add_argument(
+        "--memory-limit",
+        type=int,
+        help="Address space limit for each lagrange run in MiB")
+    parser.add_argument(
+        "--seed",
+        type=int,
+        help="Seed for the datasets. Each dataset gets its own random " +
+        "stream from it, so the same seed makes the same datasets")
+    parser.add_argument(
+        "--validate-trees",
+        action='store_true',
+        default=False,
+        help="Check every generated tree with ete3, which has to be installed")
+
+    subparsers = parser.add_subparsers(dest='command')
+    build_parser = subparsers.add_parser(
+        'build-archive',
+        help="Make a regression archive for the tester with --iters trials " +
+        "for each --taxa and --regions count, using --program as the " +
+        "reference lagrange")
+    build_parser.add_argument('archive', type=str)
     args = parser.parse_args()
 
+    if args.command == 'build-archive':
+        import regression
+        import tempfile
+        if args.program is None:
+            args.program = DEFAULT_PROGRAM
+        memory_limit = None
+        if args.memory_limit is not None:
+            memory_limit = args.memory_limit * 1024 * 1024
+        with tempfile.TemporaryDirectory() as tempdir:
+            regression.build(
+                args.prefix if args.prefix is not None else tempdir,
+                args.archive, args.regions, args.taxa, args.iters,
+                args.procs, args.program, args.timeout, memory_limit,
+                args.seed, args.validate_trees)
+        sys.exit(0)
+
     if args.resume:
         if args.prefix is None:
             rich.print(
@@ -72,6 +112,7 @@ if __name__ == "__main__":
         args.program = parameters['program_path']
         parameters['program_sha256']
         args.profile = parameters['profile']
+        args.seed = parameters.get('seed')
         if not parameters['program_sha256'] ==\
                 benchmark.compute_hash_with_path(parameters['program_path']):
             rich.print(
@@ -114,6 +155,7 @@ if __name__ == "__main__":
                 os.path.abspath(os.path.join(os.path.dirname(args.program),
                     '..'))
         print(GIT_DIR)
+        import git
         repo = git.Repo(GIT_DIR)
         commit_string = datetime.datetime.now().strftime('%Y-%m-%d') + "_"\
                 + git_describe(repo) + "_"\
@@ -128,10 +170,15 @@ if __name__ == "__main__":
         rich.print("Placing results in [red bold]{}[/red bold]".format(
             os.path.relpath(args.prefix)))
 
+    memory_limit = None
+    if args.memory_limit is not None:
+        memory_limit = args.memory_limit * 1024 * 1024
+
     start_time = timer()
     benchmark.run(args.prefix, args.regions, args.taxa, args.iters, args.procs,
                   args.program, args.profile, args.approximate, args.no_really,
-                  threading_configurations, flamegraph_cmd)
+                  threading_configurations, flamegraph_cmd, args.timeout,
+                  memory_limit, args.seed, args.validate_trees)
     end_time = timer()
     with open(os.path.join(args.prefix, "notes.md"), 'a') as notesfile:
         notesfile.write("- notes:\n")
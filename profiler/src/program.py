@@ -1,9 +1,9 @@
 #!/usr/bin/env python3
 
-import subprocess
 import os
-import util
+import json
 import result
+import rusage
 import datetime
 
 
@@ -12,10 +12,15 @@ class program:
     def __init__(self, **kwargs):
         self._binary_path = kwargs['binary_path']
         self._profile = kwargs['profile']
+        self._timeout = kwargs.get('timeout')
+        self._memory_limit = kwargs.get('memory_limit')
 
     def run(self, *args, **kwargs):
         raise NotImplementedError("Run is not implemented in the base class")
 
+    async def run_async(self, *args, **kwargs):
+        raise NotImplementedError("Run is not implemented in the base class")
+
     @property
     def binary(self):
         return os.path.abspath(self._binary_path)
@@ -30,6 +35,14 @@ class program:
     def _donefile(path):
         return os.path.join(path, ".done")
 
+    @staticmethod
+    def _usagefile(path):
+        return os.path.join(path, "usage.json")
+
+    def write_usage(self, path, usage):
+        with open(program._usagefile(path), 'w') as usagefile:
+            json.dump(usage.as_dict(), usagefile)
+
     def set_done(self, path):
         with open(program._donefile(path), 'w') as donefile:
             donefile.write(str(datetime.datetime.now()))
@@ -53,18 +66,41 @@ class lagrange(program):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
+    def _command(self, dataset):
+        cmd = []
+        cmd.extend(self.profile_cmd)
+        cmd.extend([self.binary, dataset.lagrange_config_path])
+        return cmd
+
+    def _finish(self, dataset, usage):
+        self.write_usage(dataset.path, usage)
+        self.set_done(dataset.path)
+        # Failed runs are redone on a new dataset, but one of the same size
+        # would run past the timeout again.
+        return usage.returncode == 0 or usage.timed_out
+
     def run(self, dataset):
         if self.check_done(dataset.path):
             return None
-        with util.directory_guard(dataset.path):
-            with open('lagrange.log', 'w') as logfile:
-                cmd = []
-                cmd.extend(self.profile_cmd)
-                cmd.extend([self.binary, dataset.lagrange_config_path])
-                ret = subprocess.run(cmd, stdout=logfile, stderr=logfile)
-                #self.set_done(dataset.path)
-                self.set_done('')
-                return ret.returncode == 0
+        with open(os.path.join(dataset.path, 'lagrange.log'),
+                  'w') as logfile:
+            usage = rusage.run(self._command(dataset),
+                               stdout=logfile,
+                               stderr=logfile,
+                               cwd=dataset.path,
+                               timeout=self._timeout,
+                               memory_limit=self._memory_limit)
+        return self._finish(dataset, usage)
+
+    async def run_async(self, dataset, pool):
+        if self.check_done(dataset.path):
+            return None
+        usage = await pool.run(self._command(dataset),
+                               os.path.join(dataset.path, 'lagrange.log'),
+                               cwd=dataset.path,
+                               timeout=self._timeout,
+                               memory_limit=self._memory_limit)
+        return self._finish(dataset, usage)
 
     def get_result(self, dataset):
         return lagrange_result(dataset)
@@ -77,6 +113,18 @@ class lagrange_result(result.result):
     def __init__(self, dataset, **kwargs):
         super().__init__(**kwargs)
         self._dataset = dataset
+        self._usage = None
+        if os.path.exists(program._usagefile(self._dataset.path)):
+            with open(program._usagefile(self._dataset.path)) as usagefile:
+                self._usage = rusage.process_usage.from_dict(
+                    json.load(usagefile))
+
+        # A run that was killed, or failed, never logs its time.
+        if self._usage is not None and (self._usage.timed_out
+                                        or self._usage.returncode != 0):
+            self._time = None
+            return
+
         with open(self.logfile_path) as logfile:
             time_line = list(logfile)[-1]
 
@@ -86,6 +134,14 @@ class lagrange_result(result.result):
             raise RuntimeError("Could not parse the time line for file: " +
                                self.logfile_path)
 
+    @property
+    def time(self):
+        return self._time
+
+    @property
+    def usage(self):
+        return self._usage
+
     @property
     def logfile_path(self):
         return os.path.join(self._dataset.path, self._logfile_filename)
@@ -100,7 +156,7 @@ class lagrange_result(result.result):
         return float(line[prefix_length:-1])
 
     def write_row(self):
-        return {
+        row = {
             'program': self.program,
             'taxa': self._dataset.taxa_count,
             'regions': self._dataset.region_count,
@@ -108,9 +164,12 @@ class lagrange_result(result.result):
             'tpw': self._dataset.threads_per_worker,
             'time': self._time
         }
+        if self._usage is not None:
+            row.update(self._usage.as_dict())
+        return row
 
     def header(self):
         return [
             'program', 'taxa', 'regions', 'workers', 'tpw', 'approximate',
             'time'
-        ]
+        ] + rusage.USAGE_FIELDS
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+import benchmark
+import experiment
+import program
+import trialarchive
+import itertools
+import numpy
+import os
+import rich
+import rich.progress
+
+TRIAL_FORMAT = "regression/{taxa}taxa_{regions}regions/trial_{index:03d}"
+
+
+def _reference_result(prog, ds):
+    # Only a reference run that finished and wrote its results can be used
+    # as the expected results of a trial.
+    try:
+        result = prog.get_result(ds)
+    except (OSError, RuntimeError):
+        return None
+    if result.time is None:
+        return None
+    if result.usage is not None and result.usage.returncode != 0:
+        return None
+    if not any(
+            f.endswith(trialarchive.RESULTS_SUFFIX)
+            for f in trialarchive.trial_files(ds.path)):
+        return None
+    return result
+
+
+def build(prefix,
+          archive_path,
+          regions,
+          taxa,
+          iters,
+          procs,
+          program_path,
+          timeout=None,
+          memory_limit=None,
+          seed=None,
+          validate_trees=False):
+    # Generates iters trials for each taxa and region count, runs the
+    # reference lagrange on all of them at once, and packs the inputs and
+    # reference results into a trial archive for the tester.
+    os.makedirs(prefix, exist_ok=True)
+    reference = program.lagrange(binary_path=os.path.abspath(program_path),
+                                 profile=False,
+                                 timeout=timeout,
+                                 memory_limit=memory_limit)
+
+    seed = numpy.random.SeedSequence(seed)
+    rich.print("Making the datasets with seed {}".format(seed.entropy))
+    groups = []
+    datasets = []
+    with rich.progress.Progress() as progress_bar:
+        configurations = list(itertools.product(regions, taxa))
+        make_task = progress_bar.add_task("Making datasets...",
+                                          total=len(configurations))
+        with benchmark.make_pool(procs) as pool:
+            for (r, t), group_seed in zip(configurations,
+                                          seed.spawn(len(configurations))):
+                group = "{}taxa_{}regions".format(t, r)
+                group_datasets = benchmark.make_datasets(
+                    t, r, iters, 1, False, 1,
+                    os.path.join(os.getcwd(), prefix, group), group_seed,
+                    pool, validate_trees)
+                for ds in group_datasets:
+                    ds.add_prefix_dir(group)
+                groups.append((t, r, group_datasets))
+                datasets.extend(group_datasets)
+                progress_bar.update(make_task, advance=1.0)
+
+        # A single experiment, so that every run can go to a free process.
+        exp = experiment.experiment(prefix, datasets, [reference])
+        exp.run(procs, progress_bar)
+
+    skipped = 0
+    with trialarchive.writer(archive_path) as archive:
+        for t, r, group_datasets in groups:
+            index = 0
+            for ds in group_datasets:
+                result = _reference_result(reference, ds)
+                if result is None:
+                    rich.print("[red]Leaving out {}, the reference run "
+                               "failed".format(ds.path))
+                    skipped += 1
+                    continue
+                archive.add(
+                    TRIAL_FORMAT.format(taxa=t, regions=r, index=index),
+                    ds.path, t, r, result.time)
+                index += 1
+    rich.print("Wrote {} trials to {}".format(
+        len(datasets) - skipped, archive_path))
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+import collections
+import numpy
+
+# Node ids 0 to taxa - 1 are the leaves. The inner nodes come after them,
+# in the order they were made, so every node has a larger id than its
+# children and the root is the last node. Passes over the nodes in id order
+# visit the children first, which replaces recursion.
+FLOAT_FORMAT = "{:0.6g}"
+
+
+class tree:
+    def __init__(self, names, left, right, dist):
+        self._names = names
+        self._left = left
+        self._right = right
+        self._dist = dist
+
+    @property
+    def taxa_count(self):
+        return len(self._names)
+
+    @property
+    def root(self):
+        return len(self._dist) - 1
+
+    @property
+    def names(self):
+        return self._names
+
+    def make_ultrametric(self):
+        # Lengthens the branch to the lower child of each node, so that
+        # every leaf ends up at the same depth. Returns the height of the
+        # tree, including the branch of the root.
+        dist = self._dist.tolist()
+        heights = list(dist)
+        left = self._left.tolist()
+        right = self._right.tolist()
+        for inner in range(len(left)):
+            l, r = left[inner], right[inner]
+            max_height = max(heights[l], heights[r])
+            dist[l] += max_height - heights[l]
+            dist[r] += max_height - heights[r]
+            heights[self.taxa_count + inner] += max_height
+        self._dist = numpy.array(dist)
+        return heights[self.root]
+
+    def newick(self):
+        # Leaf names and the lengths of all branches but the root's, which
+        # is what ete3 writes with format=5.
+        taxa_count = self.taxa_count
+        dist = [FLOAT_FORMAT.format(d) for d in self._dist.tolist()]
+        left = self._left.tolist()
+        right = self._right.tolist()
+        out = []
+        stack = [self.root]
+        while len(stack) != 0:
+            item = stack.pop()
+            if isinstance(item, str):
+                out.append(item)
+            elif item < taxa_count:
+                out.append(self._names[item])
+                out.append(':' + dist[item])
+            else:
+                inner = item - taxa_count
+                stack.append(')' if item == self.root else '):' + dist[item])
+                stack.append(right[inner])
+                stack.append(',')
+                stack.append(left[inner])
+                out.append('(')
+        out.append(';')
+        return ''.join(out)
+
+
+def generate(names, rng, shape=0.5):
+    # Splits leaves from the root down the way ete3's populate does, taking
+    # either the newest or the oldest leaf of a deque, so the shapes have
+    # the same distribution. The splits are made from the root down, so
+    # they are numbered in reverse to put the children first. The leaves
+    # are named in the order populate names them. Branch lengths are gamma
+    # distributed.
+    taxa_count = len(names)
+    if taxa_count < 2:
+        raise ValueError("A tree needs at least two taxa")
+    inner_count = taxa_count - 1
+    # Split k makes the nodes 2k + 1 and 2k + 2 until they are renumbered.
+    newest = rng.integers(0, 2, size=inner_count).tolist()
+    leaves = collections.deque([0])
+    split = []
+    for k in range(inner_count):
+        split.append(leaves.pop() if newest[k] else leaves.popleft())
+        leaves.extend((2 * k + 1, 2 * k + 2))
+    ids = [0] * (taxa_count + inner_count)
+    for position, node in enumerate(leaves):
+        ids[node] = taxa_count - 1 - position
+    for k, node in enumerate(split):
+        ids[node] = taxa_count + inner_count - 1 - k
+    left = [ids[2 * k + 1] for k in reversed(range(inner_count))]
+    right = [ids[2 * k + 2] for k in reversed(range(inner_count))]
+    dist = rng.gamma(shape, size=taxa_count + inner_count)
+    return tree(list(names), numpy.array(left), numpy.array(right), dist)
+
+
+def validate(newick, names, tolerance=1e-4):
+    # Checks a generated tree against ete3, which is only needed here.
+    import ete3
+    parsed = ete3.Tree(newick)
+    leaves = parsed.get_leaves()
+    if sorted(l.name for l in leaves) != sorted(names):
+        raise RuntimeError("The tree does not have the expected taxa")
+    depths = [parsed.get_distance(l) for l in leaves]
+    if max(depths) - min(depths) > tolerance * max(depths):
+        raise RuntimeError("The tree is not ultrametric")
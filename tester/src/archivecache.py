@@ -0,0 +1,154 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import directory
+import lagrangelog
+
+ARCHIVE_CACHE_VERSION = 1
+TRIALS_FILENAME = 'trials.txt'
+DIGEST_CHUNK_SIZE = 1 << 20
+DEFAULT_MAX_BYTES = 4 * 1024 * 1024 * 1024
+
+
+def archive_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(DIGEST_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def make_workspace(trial_path, workspace_path):
+    # The trial inputs are hardlinked from the cache, and lagrange writes its
+    # outputs next to them as new files, so the cached copy is never
+    # modified.
+    for subdir in ['expected', 'experiment']:
+        src_dir = os.path.join(trial_path, subdir)
+        dst_dir = os.path.join(workspace_path, subdir)
+        os.makedirs(dst_dir)
+        for f in os.listdir(src_dir):
+            if os.path.isfile(os.path.join(src_dir, f)):
+                link_or_copy(os.path.join(src_dir, f),
+                             os.path.join(dst_dir, f))
+    return (directory.ExpectedTrialDirectory(
+        os.path.join(workspace_path, 'expected')),
+            directory.ExperimentTrialDirectory(
+                os.path.join(workspace_path, 'experiment')))
+
+
+def directory_size(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            try:
+                total += os.lstat(os.path.join(root, f)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class archive_cache:
+    # Keeps converted regression archives, keyed by the SHA-256 of the
+    # archive, along with the parsed expected results. Once they take more
+    # than max_bytes, the archives used least recently are removed.
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES):
+        self._path = os.path.abspath(path)
+        self._max_bytes = max_bytes
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def max_bytes(self):
+        return self._max_bytes
+
+    def _archive_path(self, digest):
+        # The parsed results are part of the cached archive, so a new parsed
+        # format needs a new cache.
+        return os.path.join(
+            self._path, 'v{}.{}'.format(ARCHIVE_CACHE_VERSION,
+                                        lagrangelog.PARSED_VERSION), digest)
+
+    def _cached_archives(self):
+        # The modification time of the trial list records when an archive
+        # was last used. Archives kept for an older format are never used
+        # again, so they go first.
+        current = os.path.dirname(self._archive_path(''))
+        if not os.path.isdir(self._path):
+            return
+        for version in os.listdir(self._path):
+            version_path = os.path.join(self._path, version)
+            if not os.path.isdir(version_path):
+                continue
+            for digest in os.listdir(version_path):
+                archive_path = os.path.join(version_path, digest)
+                try:
+                    last_used = os.path.getmtime(
+                        os.path.join(archive_path, TRIALS_FILENAME))
+                except OSError:
+                    # Staging directories of runs still converting.
+                    continue
+                if version_path != current:
+                    last_used = 0.0
+                yield last_used, directory_size(archive_path), archive_path
+
+    def _evict(self, in_use):
+        archives = sorted(self._cached_archives())
+        total = sum(size for last_used, size, archive_path in archives)
+        for last_used, size, archive_path in archives:
+            if total <= self._max_bytes:
+                break
+            if archive_path == in_use:
+                continue
+            shutil.rmtree(archive_path, ignore_errors=True)
+            total -= size
+
+    def jobs(self, archive, prefix):
+        archive_path = self._archive_path(archive_digest(archive))
+        trials_path = os.path.join(archive_path, TRIALS_FILENAME)
+        if os.path.exists(trials_path):
+            with open(trials_path) as infile:
+                trials = infile.read().splitlines()
+            os.utime(trials_path)
+            self._evict(archive_path)
+            for trial in trials:
+                yield make_workspace(os.path.join(archive_path, trial),
+                                     os.path.join(prefix, trial))
+            return
+
+        os.makedirs(os.path.dirname(archive_path), exist_ok=True)
+        staging_path = tempfile.mkdtemp(prefix='.staging-',
+                                        dir=os.path.dirname(archive_path))
+        try:
+            trials = []
+            for expected, experiment in\
+                    directory.streamTarFileAndMakeDirectories(
+                        archive, staging_path):
+                expected.saveParsedLog()
+                trial = os.path.relpath(os.path.dirname(expected._path),
+                                        staging_path)
+                trials.append(trial)
+                yield make_workspace(os.path.join(staging_path, trial),
+                                     os.path.join(prefix, trial))
+            with open(os.path.join(staging_path, TRIALS_FILENAME),
+                      'w') as outfile:
+                outfile.write(''.join(t + '\n' for t in trials))
+            try:
+                os.rename(staging_path, archive_path)
+            except OSError:
+                # Another run cached the same archive first.
+                if not os.path.exists(trials_path):
+                    raise
+            self._evict(archive_path)
+        finally:
+            if os.path.exists(staging_path):
+                shutil.rmtree(staging_path)
@@ -2,12 +2,17 @@ from lagrangelog import *
 import lagrange
 import enum
 import tarfile
+import trialarchive
 
 
 class ExperimentFilesMissing(Exception):
     pass
 
 
+class ExperimentTimedOut(ExperimentFilesMissing):
+    pass
+
+
 class TrialDirectory:
     def __init__(self, path):
         self._path = os.path.abspath(path)
@@ -88,19 +93,45 @@ class TrialDirectory:
             os.remove(f)
         return (expected_dir, experiment_dir)
 
-    def _registerLog(self):
-        if hasattr(self, '_json_filename'):
-            self._lagrange_log = LagrangeLog(self._console_filename,
-                                             self._json_filename)
-        else:
-            self._lagrange_log = LagrangeLog(self._console_filename)
+    def _registerLog(self, reference=None):
+        self._lagrange_log = LagrangeLog(
+            self._console_filename, getattr(self, '_json_filename', None),
+            None if reference is None else reference._lagrange_log)
 
     def binaryCompare(self, other):
         return self._lagrange_log == other._lagrange_log
 
+    def exactMatch(self, other):
+        return self._lagrange_log.exactMatch(other._lagrange_log)
+
     def metricCompare(self, other):
         return self._lagrange_log.wassersteinMetric(other._lagrange_log)
 
+    def distributionMatrices(self, other):
+        return self._lagrange_log.distributionMatrices(other._lagrange_log)
+
+    def metricUpperBound(self, other):
+        return self._lagrange_log.wassersteinUpperBound(other._lagrange_log)
+
+    def normalizeMetric(self, total_dist):
+        return self._lagrange_log.normalizeMetric(total_dist)
+
+    def runtime(self):
+        return self._lagrange_log.runtime()
+
+    def saveParsedLog(self):
+        self._lagrange_log.saveParsed()
+
+    def dimensions(self):
+        return self._lagrange_log.dimensions()
+
+    def estimatedCost(self):
+        # Trials with a recorded runtime sort by it, the rest by the size of
+        # the problem.
+        runtime = self.runtime()
+        return (runtime if runtime is not None else 0.0,
+                self._lagrange_log.problemSize())
+
     def parameterVectorDifference(self, other):
         return numpy.abs(self._lagrange_log.paramsVector() -
                          other._lagrange_log.paramsVector())
@@ -117,21 +148,57 @@ class ExpectedTrialDirectory(TrialDirectory):
         super(ExpectedTrialDirectory, self).__init__(path)
         self._registerLog()
 
+    def resultFiles(self):
+        return [self._json_filename]
+
 
 class ExperimentTrialDirectory(TrialDirectory):
     def __init__(self, path):
         super(ExperimentTrialDirectory, self).__init__(path)
+        self._usage = None
+
+    def runExperiment(self, lagrange_runner, expected=None):
+        self.finishExperiment(
+            lagrange_runner.run(self._path, self._config_filename), expected)
 
-    def runExperiment(self, lagrange_runner):
-        lagrange_runner.run(self._path, self._config_filename)
+    async def runExperimentAsync(self, lagrange_runner, pool):
+        return await lagrange_runner.run_async(pool, self._path,
+                                               self._config_filename)
+
+    def finishExperiment(self, usage, expected=None):
+        self._usage = usage
+        if self._usage.timed_out:
+            self._failed = True
+            raise ExperimentTimedOut
         self.findFiles()
         try:
-            self._registerLog()
+            # A run that crashed, or hit the memory limit, leaves no results.
+            if not hasattr(self, '_json_filename'):
+                raise ExperimentFilesMissing
+            self._registerLog(expected)
         except ExperimentFilesMissing:
             self._failed = True
             raise ExperimentFilesMissing
+        except (ValueError, KeyError):
+            # A run killed while writing its results leaves them truncated.
+            self._failed = True
+            raise ExperimentFilesMissing
         self._failed = False
 
+    def usage(self):
+        return self._usage
+
+    def timedOut(self):
+        return self._usage is not None and self._usage.timed_out
+
+    def killed(self):
+        return self._usage is not None and self._usage.returncode < 0
+
+    def inputFiles(self):
+        return [
+            self._config_filename, self._align_filename, self._tree_filename
+        ]
+
     def failed(self):
         return self._failed
 
@@ -139,6 +206,18 @@ class ExperimentTrialDirectory(TrialDirectory):
         self._failed = True
 
 
+class RecordedTrialDirectory:
+    # A trial known only by its path, as read back from partial results.
+    def __init__(self, path):
+        self._path = path
+
+    def __repr__(self):
+        sub_path, basename = os.path.split(self._path)
+        if basename == 'experiment' or basename == 'expected':
+            return sub_path
+        return self._path
+
+
 class ExperimentWithDistance:
     def __init__(self, exp, dist):
         self._exp = exp
@@ -148,6 +227,15 @@ class ExperimentWithDistance:
         return "(%s, %f)" % (self._exp, self._dist)
 
 
+class ExperimentWithSlowdown:
+    def __init__(self, exp, slowdown):
+        self._exp = exp
+        self._slowdown = slowdown
+
+    def __repr__(self):
+        return "(%s, %.3fx)" % (self._exp, self._slowdown)
+
+
 def DirectoryRepresenter(dumper, data):
     return dumper.represent_scalar(u'!FailedError', u'%s' % data._path)
 
@@ -157,6 +245,11 @@ def ExperimentWithDistanceRepresenter(dumper, data):
                                    u'(%s, %f)' % (data._exp._path, data._dist))
 
 
+def ExperimentWithSlowdownRepresenter(dumper, data):
+    return dumper.represent_scalar(u'!SlowRun', u'(%s, %f)' %
+                                   (data._exp._path, data._slowdown))
+
+
 def isExperimentDirectory(files):
     for f in files:
         basename, ext = os.path.splitext(f)
@@ -189,3 +282,47 @@ def extractTarFileAndMakeDirectories(tarfile_path, destination_path, progress):
     progress.update(extract_task, visible=False)
     progress.update(convert_task, visible=False)
     return converted_directories
+
+
+def streamTarFileAndMakeDirectories(tarfile_path, destination_path):
+    # Reads the archive front to back and converts each trial directory as
+    # soon as the archive moves past it, so trials can start while the rest
+    # of the archive is still being unpacked. Tar stores the files of a
+    # directory together, so a directory is complete once a member from
+    # another directory shows up.
+    trial_dir = None
+    files = []
+
+    def convert(trial_dir, files):
+        if trial_dir is None or not isExperimentDirectory(files):
+            return None
+        return TrialDirectory(os.path.join(destination_path,
+                                           trial_dir)).convert()
+
+    with tarfile.open(tarfile_path, 'r|*') as tar:
+        for member in tar:
+            tar.extract(member, path=destination_path)
+            if not member.isfile():
+                continue
+            member_dir, member_file = os.path.split(member.name)
+            if member_dir != trial_dir:
+                job = convert(trial_dir, files)
+                if job is not None:
+                    yield job
+                trial_dir = member_dir
+                files = []
+            files.append(member_file)
+
+    job = convert(trial_dir, files)
+    if job is not None:
+        yield job
+
+
+def extractTrialArchiveAndMakeDirectories(archive_path,
+                                          destination_path,
+                                          trials=None):
+    # Trial archives can be read in any order, so only the given trials are
+    # extracted.
+    for trial_path in trialarchive.extract_trials(archive_path,
+                                                  destination_path, trials):
+        yield TrialDirectory(trial_path).convert()
@@ -0,0 +1,112 @@
+import json
+
+CHUNK_SIZE = 1 << 20
+WHITESPACE = ' \t\n\r'
+NUMBER_CHARS = '0123456789+-.eE'
+STRIP_WHITESPACE = str.maketrans('', '', WHITESPACE)
+
+
+class JSONStream:
+    def __init__(self, infile, chunk_size=CHUNK_SIZE):
+        self._infile = infile
+        self._chunk_size = chunk_size
+        self._decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        if self._eof:
+            return False
+        chunk = self._infile.read(self._chunk_size)
+        if not chunk:
+            self._eof = True
+            return False
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def _error(self, message):
+        return json.JSONDecodeError(message, self._buffer, self._pos)
+
+    def peek(self):
+        return self._peek()
+
+    def _peek(self):
+        while True:
+            while self._pos < len(self._buffer) and\
+                    self._buffer[self._pos] in WHITESPACE:
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                raise self._error("Unexpected end of the JSON stream")
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise self._error("Expecting '{}'".format(char))
+        self._pos += 1
+
+    def _next_delimiter(self, end):
+        char = self._peek()
+        self._pos += 1
+        if char == end:
+            return False
+        if char != ',':
+            raise self._error("Expecting ',' delimiter")
+        return True
+
+    def decode_value(self, digest=None):
+        # If a digest is given, it is updated with the text of the value,
+        # without whitespace, so that formatting does not change it.
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # A number that runs up to the end of the buffer might continue in
+            # the next chunk.
+            if isinstance(value, (int, float)) and\
+                    not isinstance(value, bool) and\
+                    self._buffer[end:].lstrip(NUMBER_CHARS) == '' and\
+                    self._fill():
+                continue
+            if digest is not None:
+                digest.update(self._buffer[self._pos:end].translate(
+                    STRIP_WHITESPACE).encode())
+                digest.update(b'\n')
+            self._pos = end
+            return value
+
+    def skip_value(self, digest=None):
+        self.decode_value(digest)
+
+    def iter_array(self, digest=None):
+        self._expect('[')
+        if self._peek() == ']':
+            self._pos += 1
+            return
+        while True:
+            yield self.decode_value(digest)
+            if not self._next_delimiter(']'):
+                return
+
+    def iter_object(self):
+        # Yields the keys of an object. The caller has to consume each value
+        # with decode_value, skip_value or iter_array before asking for the
+        # next key.
+        self._expect('{')
+        if self._peek() == '}':
+            self._pos += 1
+            return
+        while True:
+            key = self.decode_value()
+            if not isinstance(key, str):
+                raise self._error("Expecting a property name")
+            self._expect(':')
+            yield key
+            if not self._next_delimiter('}'):
+                return
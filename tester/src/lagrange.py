@@ -1,17 +1,32 @@
 #!/usr/bin/env python3
 
-import subprocess
-import util
-import filecmp
+import os
+import rusage
 
 
 class lagrange:
-    def __init__(self, lagrange_path):
+    def __init__(self, lagrange_path, timeout=None, memory_limit=None):
         self._lagrange_path = lagrange_path
+        self._timeout = timeout
+        self._memory_limit = memory_limit
+
+    def _command(self, config_file):
+        return [self._lagrange_path, config_file]
 
     def run(self, path, config_file):
-        with util.directory_guard(path):
-            with open('lagrange.log', 'w') as logfile:
-                subprocess.run([self._lagrange_path, config_file],
-                               stdout=logfile,
-                               stderr=logfile)
+        # The working directory is set per process rather than with
+        # util.directory_guard, so several runs can be started from threads.
+        with open(os.path.join(path, 'lagrange.log'), 'w') as logfile:
+            return rusage.run(self._command(config_file),
+                              stdout=logfile,
+                              stderr=logfile,
+                              cwd=path,
+                              timeout=self._timeout,
+                              memory_limit=self._memory_limit)
+
+    async def run_async(self, pool, path, config_file):
+        return await pool.run(self._command(config_file),
+                              os.path.join(path, 'lagrange.log'),
+                              cwd=path,
+                              timeout=self._timeout,
+                              memory_limit=self._memory_limit)
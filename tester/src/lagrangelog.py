@@ -1,5 +1,9 @@
-import json
+import array
+import distcache
+import hashlib
+import jsonstream
 import numpy
+import scipy.sparse
 import os
 import shutil
 import enum
@@ -8,6 +12,10 @@ import graph
 NODE_RESULTS_KEY = 'node-results'
 ATTRIBUTES_KEY = 'attributes'
 PARAMS_KEY = 'params'
+ANALYSIS_TIME_PREFIX = 'Analysis took: '
+PARSED_SUFFIX = '.parsed.npz'
+PARSED_VERSION = 4
+DIGEST_KEYS = [NODE_RESULTS_KEY, PARAMS_KEY]
 
 
 class LagrangeLogFileType(enum.Enum):
@@ -25,23 +33,65 @@ class LagrangeLogFileType(enum.Enum):
 
 
 class LagrangeLog:
-    def __init__(self, elog, jlog=None):
+    def __init__(self, elog, jlog=None, reference=None):
+        # When the results are the same as the reference's, the parsed
+        # results of the reference are shared. A byte for byte copy is found
+        # without parsing, anything else is parsed once and its digest is
+        # compared afterwards. The bgstates files are left out, since the
+        # expected results are converted without them.
         self._execution_log = ExecutionLog(elog)
-        if not jlog is None:
-            self._json_log = JSONLog(jlog)
-        else:
+        if jlog is None:
             raise RuntimeError(
                 "No JSON log found when parsing {}".format(elog))
+        if reference is not None and\
+                FileDigest(jlog) == reference._json_log.file_digest():
+            self._json_log = reference._json_log
+            return
+        self._json_log = JSONLog(jlog)
+        if reference is not None and\
+                self._json_log.digest() == reference.digest():
+            self._json_log = reference._json_log
 
     def __eq__(self, other):
-        return self._bgstates_log == other._bgstates_log
+        return self.digest() == other.digest()
+
+    def digest(self):
+        return self._json_log.digest()
+
+    def exactMatch(self, other):
+        return self._json_log is other._json_log
 
     def wassersteinMetric(self, other):
+        if self.exactMatch(other):
+            return 0.0
         return self._json_log.normalizedWasserSteinMetric(other._json_log)
 
+    def distributionMatrices(self, other):
+        return self._json_log.distributionMatrices(other._json_log)
+
+    def wassersteinUpperBound(self, other):
+        if self.exactMatch(other):
+            return 0.0
+        return self._json_log.normalizedWassersteinUpperBound(other._json_log)
+
+    def normalizeMetric(self, total_dist):
+        return self._json_log.normalizeMetric(total_dist)
+
     def paramsVector(self):
         return self._json_log.params_vector()
 
+    def runtime(self):
+        return self._execution_log.analysisTime()
+
+    def problemSize(self):
+        return self._json_log.problem_size()
+
+    def dimensions(self):
+        return self._json_log.dimensions()
+
+    def saveParsed(self):
+        self._json_log.save_parsed()
+
 
 class LogFile:
     def __init__(self, logfile):
@@ -68,24 +118,80 @@ class ExecutionLog(LogFile):
     def __eq__(self, other):
         raise NotImplementedError()
 
+    def analysisTime(self):
+        for line in reversed(self._file_contents.splitlines()):
+            line = line.strip()
+            if line.startswith(ANALYSIS_TIME_PREFIX):
+                try:
+                    return float(line[len(ANALYSIS_TIME_PREFIX):].rstrip('s'))
+                except ValueError:
+                    return None
+        return None
+
+
+class NodeResults:
+    def __init__(self):
+        self._numbers = array.array('q')
+        self._nodes = array.array('q')
+        self._states = array.array('q')
+        self._ratios = array.array('d')
+
+    def add(self, obj):
+        for s in obj['states']:
+            self._nodes.append(len(self._numbers))
+            self._states.append(s['distribution'])
+            self._ratios.append(s['ratio'])
+        self._numbers.append(obj['number'])
+
+    def indexes(self):
+        return numpy.sort(numpy.frombuffer(self._numbers, dtype=numpy.int64))
+
+    def distribution_matrix(self, indexes, regions):
+        numbers = numpy.frombuffer(self._numbers, dtype=numpy.int64)
+        rows = numpy.searchsorted(indexes, numbers)
+        return scipy.sparse.csr_matrix(
+            (numpy.frombuffer(self._ratios, dtype=numpy.float64),
+             (rows[numpy.frombuffer(self._nodes, dtype=numpy.int64)],
+              numpy.frombuffer(self._states, dtype=numpy.int64))),
+            shape=(len(indexes), 2**regions))
+
 
 class JSONLog(LogFile):
     def __init__(self, logfile):
         super(JSONLog, self).__init__(logfile)
-        self._log = json.loads(self._file_contents)
+        self._file_digest = None
         self._setup()
-        self._file_contents = None
-
-    def _setup_index_map(self):
-        self._indexes = []
-        for obj in self._log[NODE_RESULTS_KEY]:
-            self._indexes.append(obj['number'])
 
-        self._indexes = sorted(self._indexes)
-
-        self._index_json_map = {}
-        for obj in self._log[NODE_RESULTS_KEY]:
-            self._index_json_map[obj['number']] = obj
+    def _read_file(self):
+        # Results files can be hundreds of MB, so they are streamed in
+        # _setup instead of being read in one go.
+        return None
+
+    def _stream_results(self):
+        self._log = {}
+        node_results = NodeResults()
+        digest = hashlib.sha256()
+        with open(self._file_path) as infile:
+            stream = jsonstream.JSONStream(infile)
+            for key in stream.iter_object():
+                if key in DIGEST_KEYS:
+                    digest.update(key.encode())
+                if key == NODE_RESULTS_KEY:
+                    for obj in stream.iter_array(digest):
+                        node_results.add(obj)
+                elif key == PARAMS_KEY:
+                    self._log[key] = stream.decode_value(digest)
+                elif key == ATTRIBUTES_KEY:
+                    self._log[key] = stream.decode_value()
+                else:
+                    stream.skip_value()
+        self._digest = _finish_digest(digest, self._log.get(ATTRIBUTES_KEY))
+        return node_results
+
+    def _setup_distributions(self, node_results):
+        self._indexes = node_results.indexes()
+        self._distributions = node_results.distribution_matrix(
+            self._indexes, self._regions)
 
     def _setup_read_attributes(self):
         self._regions = self._log[ATTRIBUTES_KEY]['regions']
@@ -94,40 +200,135 @@ class JSONLog(LogFile):
         self._extinction_rate = self._log[PARAMS_KEY]['extinction']
 
     def _setup(self):
-        self._setup_index_map()
+        if os.path.exists(self._parsed_path()) and self._load_parsed():
+            return
+        node_results = self._stream_results()
         self._setup_read_attributes()
+        self._setup_distributions(node_results)
+        self._log = None
+
+    def _parsed_path(self):
+        return self._file_path + PARSED_SUFFIX
+
+    def _load_parsed(self):
+        # Parsed results written by another version are ignored, and the
+        # JSON is parsed instead.
+        with numpy.load(self._parsed_path()) as parsed:
+            if int(parsed['version']) != PARSED_VERSION:
+                return False
+            self._indexes = parsed['indexes']
+            self._distributions = scipy.sparse.csr_matrix(
+                (parsed['data'], parsed['indices'], parsed['indptr']),
+                shape=tuple(parsed['shape']))
+            self._regions = int(parsed['regions'])
+            self._taxa = int(parsed['taxa'])
+            self._dispersion_rate, self._extinction_rate = parsed['params']
+            self._digest = str(parsed['digest'])
+            self._file_digest = str(parsed['file_digest'])
+        self._log = None
+        return True
+
+    def save_parsed(self):
+        # Keeps the parsed results next to the JSON file, so that later
+        # reads skip parsing it.
+        tmp_path = self._parsed_path() + '.tmp'
+        with open(tmp_path, 'wb') as outfile:
+            numpy.savez(outfile,
+                        version=PARSED_VERSION,
+                        indexes=self._indexes,
+                        data=self._distributions.data,
+                        indices=self._distributions.indices,
+                        indptr=self._distributions.indptr,
+                        shape=self._distributions.shape,
+                        regions=self._regions,
+                        taxa=self._taxa,
+                        params=self.params_vector(),
+                        digest=self._digest,
+                        file_digest=self.file_digest())
+        os.replace(tmp_path, self._parsed_path())
 
     def distribution_vector(self, index, regions):
-        obj = self._index_json_map[index]
-        dist_vec = numpy.zeros(2**regions)
-        for s in obj['states']:
-            dist_vec[s['distribution']] = s['ratio']
+        return self.distribution_matrix([index], regions)
 
-        return dist_vec
+    def distribution_matrix(self, indexes, regions):
+        rows = numpy.searchsorted(self._indexes, indexes)
+        return FitStates(self._distributions[rows], regions)
 
     def params_vector(self):
         return numpy.array([self._dispersion_rate, self._extinction_rate])
 
+    def digest(self):
+        return self._digest
+
+    def file_digest(self):
+        if self._file_digest is None:
+            self._file_digest = FileDigest(self._file_path)
+        return self._file_digest
+
+    def problem_size(self):
+        return self._taxa * 2**self._regions
+
+    def dimensions(self):
+        return (self._taxa, self._regions)
+
     def __and__(self, other):
-        return sorted(set(self._indexes) & set(other._indexes))
+        return numpy.intersect1d(self._indexes, other._indexes)
 
     def __eq__(self, other):
         raise NotImplementedError()
 
-    def wassersteinMetric(self, other):
+    def distributionMatrices(self, other):
         if self._regions != other._regions:
             raise RuntimeError(
                 "The two lagrange runs should have the same" +
                 "number of regions to compare compute the wasserstein" +
                 "metric")
-        total_dist = 0.0
-        for d1, d2 in DistributionVectorGenerator(self, other, self._regions):
-            p = graph.problem(d1 - d2)
-            total_dist += p.normalized_dist()
-        return total_dist
+        return DistributionMatrices(self, other, self._regions)
+
+    def wassersteinMetric(self, other):
+        d1, d2 = self.distributionMatrices(other)
+        return numpy.sum(distcache.cached_normalized_dist(d1, d2))
+
+    def normalizeMetric(self, total_dist):
+        return total_dist / (self._taxa - 1)
 
     def normalizedWasserSteinMetric(self, other):
-        return self.wassersteinMetric(other) / (self._taxa - 1)
+        return self.normalizeMetric(self.wassersteinMetric(other))
+
+    def normalizedWassersteinUpperBound(self, other):
+        d1, d2 = self.distributionMatrices(other)
+        return self.normalizeMetric(
+            numpy.sum(graph.batch_normalized_dist_upper_bound(d1, d2)))
+
+
+def _finish_digest(digest, attributes):
+    # Only the attributes that the comparison reads are part of the digest,
+    # so that results with a different region or taxa count never match.
+    if attributes is not None:
+        digest.update('{} {}'.format(attributes.get('regions'),
+                                     attributes.get('taxa')).encode())
+    return digest.hexdigest()
+
+
+def FileDigest(filename):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(jsonstream.CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def FitStates(dist_mat, regions):
+    states = 2**regions
+    if dist_mat.shape[1] == states:
+        return dist_mat
+    if dist_mat.shape[1] > states:
+        raise RuntimeError(
+            "The distributions have more states than {} regions allow".format(
+                regions))
+    return scipy.sparse.csr_matrix(
+        (dist_mat.data, dist_mat.indices, dist_mat.indptr),
+        shape=(dist_mat.shape[0], states))
 
 
 def DistributionVectorGenerator(json1, json2, regions):
@@ -136,3 +337,9 @@ def DistributionVectorGenerator(json1, json2, regions):
         d1 = json1.distribution_vector(i, regions)
         d2 = json2.distribution_vector(i, regions)
         yield (d1, d2)
+
+
+def DistributionMatrices(json1, json2, regions):
+    inds = json1 & json2
+    return (json1.distribution_matrix(inds, regions),
+            json2.distribution_matrix(inds, regions))
@@ -2,7 +2,13 @@
 
 import argparse
 import tester
+import distcache
+import archivecache
+import resultstore
+import retention
 import tempfile
+import sys
+import re
 import os
 
 SOURCE_DIR = os.path.dirname(os.path.abspath(os.path.realpath(__file__)))
@@ -12,14 +18,154 @@ DEFAULT_ARCHIVE = os.path.abspath(os.path.join(SOURCE_DIR,
     "../archives/regression_tests_short_created_2020-06-05.tar.gz"))
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
+    parser = argparse.ArgumentParser(
+        epilog='Exits with status {} when trials fail or give wrong results, '
+        'and with {} when they only ran slower than the --baseline'.format(
+            tester.STATUS_FAILED, tester.STATUS_SLOWER))
     parser.add_argument('--prefix', type=str)
-    parser.add_argument('--archive', type=str, default=DEFAULT_ARCHIVE)
+    parser.add_argument(
+        '--archive',
+        type=str,
+        default=DEFAULT_ARCHIVE,
+        help='A .tar.gz regression archive, or a trial archive made by ' +
+        'the build-archive command of the profiler')
     parser.add_argument('--program', type=str, default=DEFAULT_PROGRAM)
     parser.add_argument('--fail-threshold', type=int, default=10)
     parser.add_argument('--distance-threshold', type=float, default=1e-4)
+    parser.add_argument(
+        '--keep',
+        action='append',
+        metavar='passing-sample=N',
+        help='When the run fails without a --prefix, the failing trials ' +
+        'are saved to a compressed bundle in the current directory. Also ' +
+        'save N passing trials picked at random')
+    parser.add_argument('--procs',
+                        '--jobs',
+                        type=int,
+                        default=1,
+                        help='Number of lagrange runs to execute at once')
+    parser.add_argument('--check-procs', type=int, default=1)
+    parser.add_argument(
+        '--fail-fast',
+        action='store_true',
+        default=False,
+        help='Run the trials that failed most often in the stored results ' +
+        'first, check each one as soon as it finishes, and stop once more ' +
+        'than --fail-threshold trials have failed')
+    parser.add_argument(
+        '--timeout',
+        type=float,
+        help='Kill a lagrange run after this many seconds, and count the ' +
+        'trial as timed out')
+    parser.add_argument(
+        '--memory-limit',
+        type=int,
+        help='Address space limit for each lagrange run in MiB')
+    parser.add_argument(
+        '--bound-check',
+        action='store_true',
+        default=False,
+        help='Accept trials whose distance upper bound is within the ' +
+        'threshold without computing the exact distance. These trials are ' +
+        'left out of the parameter error regression.')
+    parser.add_argument('--cache-dir',
+                        type=str,
+                        default=distcache.DEFAULT_CACHE_DIR)
+    parser.add_argument('--cache-size',
+                        type=int,
+                        default=distcache.DEFAULT_MAX_BYTES // (1024 * 1024),
+                        help='Size of the distance cache in MiB')
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        default=False,
+        help='Neither read nor fill the distance and archive caches in ' +
+        '--cache-dir. Results are still stored there for --incremental ' +
+        'and --baseline')
+    parser.add_argument(
+        '--no-archive-cache',
+        action='store_true',
+        default=False,
+        help='Extract the archive into the prefix instead of reusing a ' +
+        'converted copy kept in the cache directory')
+    parser.add_argument(
+        '--archive-cache-size',
+        type=int,
+        default=archivecache.DEFAULT_MAX_BYTES // (1024 * 1024),
+        help='Size of the archive cache in MiB. The archives used least ' +
+        'recently are removed once it grows past this')
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        default=False,
+        help='Only run the trials that have no stored result for this ' +
+        'lagrange binary')
+    parser.add_argument(
+        '--sample',
+        type=int,
+        help='Run this many trials, spread over the taxa and region counts ' +
+        'in the archive in proportion, with at least one trial for each')
+    parser.add_argument('--sample-seed', type=int, default=0)
+    parser.add_argument(
+        '--baseline',
+        type=str,
+        help='Compare runtimes with the stored results of this lagrange ' +
+        'binary, given as a path or a SHA-256 digest')
+    parser.add_argument(
+        '--runtime-tolerance',
+        type=float,
+        default=0.2,
+        help='Flag trials that run this fraction slower than the baseline')
+    parser.add_argument(
+        '--shard',
+        type=str,
+        help='Only run shard i/N of the archive, counting from 1. Each ' +
+        'shard writes its results to {} in its prefix'.format(
+            tester.PARTIAL_RESULTS_FILENAME))
+
+    subparsers = parser.add_subparsers(dest='command')
+    merge_parser = subparsers.add_parser(
+        'merge', help='Combine the partial results of sharded runs')
+    merge_parser.add_argument(
+        'partials',
+        nargs='+',
+        help='Partial results files, or the prefixes that hold them')
+    merge_parser.add_argument('--prefix', type=str, default='.')
+    merge_parser.add_argument('--distance-threshold',
+                              type=float,
+                              default=1e-4)
+    merge_parser.add_argument('--runtime-tolerance', type=float, default=0.2)
     args = parser.parse_args()
 
+    if args.command == 'merge':
+        sys.exit(
+            tester.merge(args.partials, args.prefix, args.distance_threshold,
+                         args.runtime_tolerance))
+
+    try:
+        keep = retention.parse_keep(args.keep)
+    except ValueError as e:
+        parser.error(str(e))
+
+    shard, shards = None, None
+    if args.shard is not None:
+        try:
+            shard, shards = tester.parse_shard(args.shard)
+        except ValueError as e:
+            parser.error(str(e))
+
+    if not args.no_cache:
+        distcache.configure(args.cache_dir, args.cache_size * 1024 * 1024)
+
+    archive_cache = None
+    if not args.no_cache and not args.no_archive_cache:
+        archive_cache = archivecache.archive_cache(
+            os.path.join(args.cache_dir, 'archives'),
+            args.archive_cache_size * 1024 * 1024)
+
+    result_store = resultstore.result_store(
+        os.path.join(args.cache_dir, resultstore.RESULTS_FILENAME))
+
     prefix_specified = True
     if args.prefix is None:
         prefix_specified = False
@@ -27,6 +173,40 @@ if __name__ == "__main__":
         print("Using the tempdir:", tempdir.name)
         args.prefix = tempdir.name
 
+    baseline = None
+    if args.baseline is not None:
+        if os.path.isfile(args.baseline):
+            baseline = resultstore.file_digest(args.baseline)
+        elif re.fullmatch('[0-9a-f]{64}', args.baseline):
+            baseline = args.baseline
+        else:
+            parser.error("--baseline should be a file or a SHA-256 digest")
+
+    memory_limit = None
+    if args.memory_limit is not None:
+        memory_limit = args.memory_limit * 1024 * 1024
+
     args.program = os.path.abspath(args.program)
-    tester.run(args.prefix, args.archive, args.program, prefix_specified,
-            args.fail_threshold, args.distance_threshold)
+    status = tester.run(args.prefix,
+                        args.archive,
+                        args.program,
+                        prefix_specified,
+                        args.fail_threshold,
+                        args.distance_threshold,
+                        check_procs=args.check_procs,
+                        bound_check=args.bound_check,
+                        procs=args.procs,
+                        archive_cache=archive_cache,
+                        result_store=result_store,
+                        incremental=args.incremental,
+                        sample=args.sample,
+                        sample_seed=args.sample_seed,
+                        shard=shard,
+                        shards=shards,
+                        timeout=args.timeout,
+                        memory_limit=memory_limit,
+                        baseline=baseline,
+                        runtime_tolerance=args.runtime_tolerance,
+                        fail_fast=args.fail_fast,
+                        keep_passing=keep['passing-sample'])
+    sys.exit(status)
@@ -0,0 +1,112 @@
+import hashlib
+import os
+import sqlite3
+import time
+
+RESULTS_FILENAME = 'results.sqlite'
+DIGEST_CHUNK_SIZE = 1 << 20
+
+# The trial ran and its distance was computed.
+OUTCOME_COMPLETED = 'completed'
+# The trial ran and the upper bound on its distance was within the
+# threshold, so the stored distance is that bound.
+OUTCOME_BOUNDED = 'bounded'
+# Lagrange did not produce its output files.
+OUTCOME_ERROR = 'error'
+# Lagrange was killed after running past the time limit.
+OUTCOME_TIMEOUT = 'timeout'
+# Lagrange died to a signal, as it does when it runs out of the memory it
+# was allowed, and left no results.
+OUTCOME_KILLED = 'killed'
+# Lagrange ran, but the distance to the expected results could not be
+# computed.
+OUTCOME_UNCHECKED = 'unchecked'
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(DIGEST_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def trial_digest(paths):
+    digest = hashlib.sha256()
+    for path in paths:
+        digest.update(file_digest(path).encode())
+    return digest.hexdigest()
+
+
+class result_store:
+    # Remembers the outcome of each trial for a given lagrange binary, keyed
+    # by the hashes of the binary and of the trial inputs.
+    def __init__(self, path):
+        self._path = os.path.abspath(path)
+        self._connection = None
+
+    @property
+    def path(self):
+        return self._path
+
+    def _connect(self):
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            # The archive is read from a worker thread when the trials are
+            # run from an event loop. Only one thread uses the store at a
+            # time.
+            self._connection = sqlite3.connect(self._path,
+                                               timeout=60,
+                                               check_same_thread=False)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS results (binary TEXT, " +
+                "trial TEXT, outcome TEXT, distance REAL, runtime REAL, " +
+                "recorded REAL, PRIMARY KEY (binary, trial))")
+        return self._connection
+
+    def get(self, binary, trial):
+        connection = self._connect()
+        return connection.execute(
+            "SELECT outcome, distance, runtime FROM results WHERE " +
+            "binary = ? AND trial = ?", (binary, trial)).fetchone()
+
+    def failure_history(self, distance_threshold):
+        # For each trial, the number of binaries it was run with and the
+        # number of those that failed it.
+        history = {}
+        for trial, outcome, distance in self._connect().execute(
+                "SELECT trial, outcome, distance FROM results"):
+            runs, failures = history.get(trial, (0, 0))
+            if failed(outcome, distance, distance_threshold):
+                failures += 1
+            history[trial] = (runs + 1, failures)
+        return history
+
+    def put_many(self, binary, records):
+        connection = self._connect()
+        now = time.time()
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)",
+                [(binary, trial, outcome, distance, runtime, now)
+                 for trial, outcome, distance, runtime in records])
+
+
+def failed(outcome, distance, distance_threshold):
+    if outcome == OUTCOME_COMPLETED:
+        return distance > distance_threshold
+    return outcome != OUTCOME_BOUNDED
+
+
+def reusable(record, distance_threshold):
+    if record is None:
+        return False
+    outcome, distance, runtime = record
+    # Whether a trial times out or runs out of memory depends on the limits
+    # it was given.
+    if outcome == OUTCOME_TIMEOUT or outcome == OUTCOME_KILLED:
+        return False
+    # A bound only settles the trial if it is within the current threshold.
+    if outcome == OUTCOME_BOUNDED:
+        return distance <= distance_threshold
+    return True
@@ -0,0 +1,103 @@
+import io
+import json
+import os
+import random
+import tarfile
+import lagrangelog
+import resultstore
+
+BUNDLE_SUFFIX = '.tar.gz'
+INDEX_FILENAME = 'index.json'
+COMPRESS_LEVEL = 6
+
+
+def parse_keep(options):
+    # Each option is NAME=VALUE. The only one so far is passing-sample=N,
+    # which keeps N passing trials to compare the failing ones against.
+    keep = {'passing-sample': 0}
+    for option in options or []:
+        name, sep, value = option.partition('=')
+        if name not in keep or sep == '':
+            raise ValueError(
+                "--keep should be one of {}, given as NAME=N".format(
+                    ', '.join(sorted(keep))))
+        try:
+            keep[name] = int(value)
+        except ValueError:
+            raise ValueError("--keep {} should be a number".format(name))
+        if keep[name] < 0:
+            raise ValueError("--keep {} should not be negative".format(name))
+    return keep
+
+
+def select_trials(records, distance_threshold, passing_sample=0, seed=0):
+    failing = []
+    passing = []
+    for record in records:
+        if resultstore.failed(record['outcome'], record['distance'],
+                              distance_threshold):
+            failing.append(record)
+        else:
+            passing.append(record)
+    passing = random.Random(seed).sample(passing,
+                                         min(passing_sample, len(passing)))
+    return failing, passing
+
+
+def _trial_files(trial_path):
+    # The parsed results are derived from the JSON files, so they are left
+    # out.
+    for root, dirs, files in os.walk(trial_path):
+        dirs.sort()
+        for filename in sorted(files):
+            if not filename.endswith(lagrangelog.PARSED_SUFFIX):
+                yield os.path.join(root, filename)
+
+
+def _index_entry(prefix, record):
+    entry = dict(record)
+    entry['path'] = os.path.relpath(record['path'], prefix)
+    return entry
+
+
+def write_bundle(bundle_path,
+                 prefix,
+                 records,
+                 distance_threshold,
+                 report_files=(),
+                 passing_sample=0,
+                 seed=0):
+    # Packs the failing trials, and a sample of the passing ones, from the
+    # prefix into one compressed archive. The index lists the results of
+    # the trials in it, with paths relative to the top directory of the
+    # bundle.
+    failing, passing = select_trials(records, distance_threshold,
+                                     passing_sample, seed)
+    name = os.path.basename(bundle_path)
+    if name.endswith(BUNDLE_SUFFIX):
+        name = name[:-len(BUNDLE_SUFFIX)]
+    index = json.dumps({
+        'distance-threshold': distance_threshold,
+        'failing': [_index_entry(prefix, r) for r in failing],
+        'passing-sample': [_index_entry(prefix, r) for r in passing],
+    }).encode()
+
+    staging = bundle_path + '.partial'
+    with tarfile.open(staging, 'w:gz',
+                      compresslevel=COMPRESS_LEVEL) as bundle:
+        info = tarfile.TarInfo(os.path.join(name, INDEX_FILENAME))
+        info.size = len(index)
+        bundle.addfile(info, io.BytesIO(index))
+        for filename in report_files:
+            path = os.path.join(prefix, filename)
+            if os.path.exists(path):
+                bundle.add(path, arcname=os.path.join(name, filename))
+        for record in failing + passing:
+            trial_path = os.path.dirname(record['path'])
+            for path in _trial_files(trial_path):
+                bundle.add(path,
+                           arcname=os.path.join(name,
+                                                os.path.relpath(path, prefix)),
+                           recursive=False)
+    os.replace(staging, bundle_path)
+    return len(failing), len(passing)
@@ -0,0 +1,197 @@
+import asyncio
+import os
+import resource
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+USAGE_FIELDS = [
+    'wall_time', 'user_time', 'sys_time', 'max_rss', 'voluntary_switches',
+    'involuntary_switches', 'returncode', 'timed_out'
+]
+
+# ru_maxrss is in KiB on Linux and in bytes on macOS.
+MAX_RSS_SCALE = 1 if sys.platform == 'darwin' else 1024
+
+
+class process_usage:
+    def __init__(self, wall_time, returncode, timed_out, rusage=None):
+        self.wall_time = wall_time
+        self.returncode = returncode
+        self.timed_out = timed_out
+        self.user_time = None
+        self.sys_time = None
+        self.max_rss = None
+        self.voluntary_switches = None
+        self.involuntary_switches = None
+        if rusage is not None:
+            self.user_time = rusage.ru_utime
+            self.sys_time = rusage.ru_stime
+            self.max_rss = rusage.ru_maxrss * MAX_RSS_SCALE
+            self.voluntary_switches = rusage.ru_nvcsw
+            self.involuntary_switches = rusage.ru_nivcsw
+
+    def as_dict(self):
+        return {f: getattr(self, f) for f in USAGE_FIELDS}
+
+    @staticmethod
+    def from_dict(values):
+        usage = process_usage(values['wall_time'], values['returncode'],
+                              values['timed_out'])
+        for f in USAGE_FIELDS:
+            setattr(usage, f, values.get(f))
+        return usage
+
+
+def _limit_memory(memory_limit):
+    def set_limit():
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+    return set_limit
+
+
+def _spawn(cmd, stdout, stderr, cwd, memory_limit):
+    # preexec_fn is not safe when the caller runs several processes from
+    # threads, so on Linux the limit is set on the child once it started.
+    preexec_fn = None
+    if memory_limit is not None and not hasattr(resource, 'prlimit'):
+        preexec_fn = _limit_memory(memory_limit)
+    # The child leads its own process group, so that anything it starts,
+    # such as lagrange under perf, is killed with it.
+    proc = subprocess.Popen(cmd,
+                            stdout=stdout,
+                            stderr=stderr,
+                            cwd=cwd,
+                            preexec_fn=preexec_fn,
+                            start_new_session=True)
+    if memory_limit is not None and preexec_fn is None:
+        resource.prlimit(proc.pid, resource.RLIMIT_AS,
+                         (memory_limit, memory_limit))
+    return proc
+
+
+def _kill(proc):
+    # The child is not reaped yet, so its process group still exists.
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def _reap(proc, start, timed_out):
+    pid, status, rusage = os.wait4(proc.pid, 0)
+    wall_time = time.monotonic() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return process_usage(wall_time, proc.returncode, timed_out, rusage)
+
+
+def run(cmd, stdout=None, stderr=None, cwd=None, timeout=None,
+        memory_limit=None):
+    # Runs cmd and collects its resource usage with wait4. A process that
+    # runs past the timeout (in seconds) is killed, and memory_limit (in
+    # bytes) caps its address space.
+    start = time.monotonic()
+    proc = _spawn(cmd, stdout, stderr, cwd, memory_limit)
+
+    timed_out = threading.Event()
+
+    def kill():
+        timed_out.set()
+        _kill(proc)
+
+    timer = None
+    if timeout is not None:
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+    try:
+        # Wait for the exit without reaping the process, so that the timer
+        # can never signal a pid that has been reused.
+        os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOWAIT)
+    except BaseException:
+        # The child is in its own session, so an interrupt does not reach
+        # it.
+        _kill(proc)
+        _reap(proc, start, timed_out.is_set())
+        raise
+    finally:
+        if timer is not None:
+            timer.cancel()
+            timer.join()
+    return _reap(proc, start, timed_out.is_set())
+
+
+async def _wait_for_exit(pid):
+    # Waits without reaping, like run. A pidfd becomes readable when the
+    # process exits, so no thread is needed per process where pidfds exist.
+    loop = asyncio.get_running_loop()
+    try:
+        pidfd = os.pidfd_open(pid)
+    except (AttributeError, OSError):
+        await loop.run_in_executor(None, os.waitid, os.P_PID, pid,
+                                   os.WEXITED | os.WNOWAIT)
+        return
+    exited = loop.create_future()
+
+    def on_exit():
+        if not exited.done():
+            exited.set_result(None)
+
+    loop.add_reader(pidfd, on_exit)
+    try:
+        await exited
+    finally:
+        loop.remove_reader(pidfd)
+        os.close(pidfd)
+
+
+async def run_async(cmd,
+                    stdout=None,
+                    stderr=None,
+                    cwd=None,
+                    timeout=None,
+                    memory_limit=None):
+    # The same as run, for use from an event loop. The output goes straight
+    # to the given files, without passing through this process.
+    start = time.monotonic()
+    proc = _spawn(cmd, stdout, stderr, cwd, memory_limit)
+    loop = asyncio.get_running_loop()
+    timed_out = False
+
+    def kill():
+        nonlocal timed_out
+        timed_out = True
+        _kill(proc)
+
+    timer = None
+    if timeout is not None:
+        timer = loop.call_later(timeout, kill)
+    try:
+        await _wait_for_exit(proc.pid)
+    except asyncio.CancelledError:
+        # Do not leave the process running when the caller gives up on it.
+        _kill(proc)
+        _reap(proc, start, timed_out)
+        raise
+    finally:
+        if timer is not None:
+            timer.cancel()
+    return _reap(proc, start, timed_out)
+
+
+class process_pool:
+    # Runs processes from an event loop, at most concurrency of them at once.
+    def __init__(self, concurrency):
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(self,
+                  cmd,
+                  log_path,
+                  cwd=None,
+                  timeout=None,
+                  memory_limit=None):
+        async with self._semaphore:
+            with open(log_path, 'w') as logfile:
+                return await run_async(cmd, logfile, logfile, cwd, timeout,
+                                       memory_limit)
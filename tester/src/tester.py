@@ -1,96 +1,472 @@
 #!/usr/bin/env python3
+import asyncio
 import os
-import tarfile
-import argparse
-import pathlib
-import util
+import json
 import random
 import lagrange
 import directory
 import rich
 import rich.console
 import rich.progress
-import yaml
-import enum
-import shutil
 import numpy
-import scipy.stats
-from sklearn.linear_model import LinearRegression
+import graph
+import distcache
+import resultstore
+import retention
+import trialarchive
+import rusage
+import multiprocessing
+import multiprocessing.pool
+import threading
+import math
+import sqlite3
 from timeit import default_timer as timer
-from matplotlib import pyplot
 
+CHECK_CHUNK_SIZE = 256
+SHUFFLE_SEED = 0
+# A broken cache or file system says nothing about the trial, so these are
+# raised instead of leaving the trial unchecked.
+CHECK_INFRASTRUCTURE_ERRORS = (sqlite3.Error, OSError)
+PARTIAL_RESULTS_FILENAME = 'partial_results.json'
+# Exit statuses. Slower runs do not make the results wrong, but they should
+# not pass as a clean run either.
+STATUS_PASSED = 0
+STATUS_FAILED = 1
+STATUS_SLOWER = 3
+SUCCESSFUL_OUTCOMES = [
+    resultstore.OUTCOME_COMPLETED, resultstore.OUTCOME_BOUNDED,
+    resultstore.OUTCOME_UNCHECKED
+]
+ERROR_OUTCOMES = [
+    resultstore.OUTCOME_ERROR, resultstore.OUTCOME_TIMEOUT,
+    resultstore.OUTCOME_KILLED
+]
 
-def run(prefix, archive, program, prefix_specified, copy_threshold,
-        distance_threshold):
-    start = timer()
-    failed_runs = []
-    error_runs = []
-    lagrange_runner = lagrange.lagrange(program)
 
-    console = rich.console.Console()
-    linreg_xs = []
-    linreg_ys = []
+class BoundedDistance:
+    # A trial whose distance upper bound is already within the threshold, so
+    # its exact distance was never computed.
+    def __init__(self, upper):
+        self._upper = upper
+
+
+def _run_experiment(expected, experiment, lagrange_runner):
+    try:
+        experiment.runExperiment(lagrange_runner, expected)
+    except directory.ExperimentFilesMissing:
+        return False
+    return True
+
+
+def _finish_experiment(expected, experiment, usage, on_finished=None):
+    try:
+        experiment.finishExperiment(usage, expected)
+        ran = True
+    except directory.ExperimentFilesMissing:
+        ran = False
+    stop = on_finished is not None and on_finished(expected, experiment)
+    return ran, stop
+
+
+def longest_first(expected):
+    # Of the trials extracted so far, the longest is started first so that
+    # the long ones do not end up as the tail of the run.
+    cost = expected.estimatedCost()
+    return (-cost[0], -cost[1])
 
-    with rich.progress.Progress() as progress:
-        jobs = directory.extractTarFileAndMakeDirectories(
-            archive, prefix, progress)
 
-        random.shuffle(jobs)
+def in_order(expected):
+    return ()
 
-        work_task = progress.add_task("[red]Running...", total=len(jobs))
-        for expected, experiment in jobs:
-            try:
-                experiment.runExperiment(lagrange_runner)
-            except directory.ExperimentFilesMissing:
+
+async def _run_experiments_async(job_stream, lagrange_runner, procs,
+                                 progress, extract_task, work_task, priority,
+                                 on_finished):
+    # Errors are reported in job order, as in a serial run.
+    jobs = []
+    run_queue = asyncio.PriorityQueue()
+    errored = set()
+    finished = set()
+    stopped = False
+    pool = rusage.process_pool(procs)
+
+    async def worker():
+        nonlocal stopped
+        while True:
+            key, index, job = await run_queue.get()
+            if job is None:
+                return
+            # Once the run is stopped, the queued trials are dropped. The
+            # runs already started are let finish, and are reported.
+            if stopped:
+                continue
+            expected, experiment = job
+            usage = await experiment.runExperimentAsync(lagrange_runner, pool)
+            # Parsing the results blocks, so it is kept off the event loop.
+            ran, stop = await asyncio.to_thread(_finish_experiment, expected,
+                                                experiment, usage,
+                                                on_finished)
+            if not ran:
+                errored.add(experiment)
+            finished.add(experiment)
+            stopped = stopped or stop
+            progress.update(work_task, advance=1.0)
+
+    workers = [asyncio.create_task(worker()) for _ in range(procs)]
+    stream = iter(job_stream)
+    try:
+        while not stopped and not any(w.done() for w in workers):
+            job = await asyncio.to_thread(next, stream, None)
+            if job is None:
+                break
+            expected, experiment = job
+            run_queue.put_nowait((priority(expected), len(jobs), job))
+            jobs.append(job)
+            progress.update(extract_task, advance=1.0)
+            progress.update(work_task, total=len(jobs))
+        # Sentinels sort after every trial, so the queue is drained first.
+        for index in range(procs):
+            run_queue.put_nowait(((math.inf, ), index, None))
+        await asyncio.gather(*workers)
+    except BaseException:
+        # Cancelled workers kill the lagrange processes they started.
+        for w in workers:
+            w.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        raise
+    jobs = [(expected, experiment) for expected, experiment in jobs
+            if experiment in finished]
+    return jobs, [
+        experiment for expected, experiment in jobs if experiment in errored
+    ]
+
+
+def run_experiments(job_stream,
+                    lagrange_runner,
+                    procs,
+                    progress,
+                    extract_task,
+                    work_task,
+                    priority=longest_first,
+                    on_finished=None):
+    # Trials are run as they come out of the archive. Returns the jobs that
+    # ran, in the order they were extracted, along with the trials that
+    # errored. on_finished is called with each trial once it has run, from
+    # a worker thread when running in parallel, and returning True stops the
+    # run.
+    if procs is None or procs == 1:
+        jobs = []
+        error_runs = []
+        for expected, experiment in job_stream:
+            jobs.append((expected, experiment))
+            progress.update(extract_task, advance=1.0)
+            progress.update(work_task, total=len(jobs))
+            if not _run_experiment(expected, experiment, lagrange_runner):
                 error_runs.append(experiment)
             progress.update(work_task, advance=1.0)
+            if on_finished is not None and on_finished(expected, experiment):
+                break
+        return jobs, error_runs
+    return asyncio.run(
+        _run_experiments_async(job_stream, lagrange_runner, procs, progress,
+                               extract_task, work_task, priority,
+                               on_finished))
 
-        check_task = progress.add_task("[red]Checking...", total=len(jobs))
 
-        for expected, experiment in jobs:
-            if experiment.failed():
-                rich.print("Exp {} failed".format(experiment))
-                progress.update(check_task, advance=1.0)
-                continue
-            parameter_diff = expected.parameterVectorDifference(experiment)
-            try:
+def _node_distances(matrices):
+    try:
+        return graph.batch_normalized_dist(*matrices)
+    except Exception:
+        return None
+
+
+def _serial_distances(jobs, threshold=None):
+    for expected, experiment in jobs:
+        if experiment.failed():
+            yield None
+            continue
+        try:
+            if expected.exactMatch(experiment):
+                dist = 0.0
+            elif threshold is not None:
+                upper = expected.metricUpperBound(experiment)
+                if upper <= threshold:
+                    dist = BoundedDistance(upper)
+                else:
+                    dist = expected.metricCompare(experiment)
+            else:
                 dist = expected.metricCompare(experiment)
-            except:
-                rich.print("Exp {} failed".format(experiment))
-                experiment.setFailed()
-                progress.update(check_task, advance=1.0)
-                continue
+        except CHECK_INFRASTRUCTURE_ERRORS:
+            raise
+        except Exception:
+            dist = None
+        yield dist
 
-            linreg_xs.append(parameter_diff)
-            linreg_ys.append(dist)
-            if dist > distance_threshold:
-                failed_runs.append(
-                    directory.ExperimentWithDistance(experiment, dist))
-            progress.update(check_task, advance=1.0)
 
-    if len(linreg_xs) > 0:
+def _parallel_distances(jobs, procs, threshold=None):
+    # Trials are split into node chunks so that large trees are spread over
+    # the pool too. The per-node distances are put back together in job
+    # order before summing, so the totals are identical to a serial check.
+    tasks = []
+    owners = []
+    parts = [[] for _ in jobs]
+    remaining = [0 for _ in jobs]
+    failed = [False for _ in jobs]
+    bounded = [None for _ in jobs]
+    keys = [None for _ in jobs]
+    cache = distcache.get_cache()
+    for index, (expected, experiment) in enumerate(jobs):
+        if experiment.failed():
+            failed[index] = True
+            continue
         try:
-            linreg_result = LinearRegression().fit(linreg_xs, linreg_ys)
-            linreg_rsquared = linreg_result.score(linreg_xs, linreg_ys)
-            console.print("Parameter error regression coefficient: {}".format(
-                linreg_rsquared))
-        except:
-            rich.print("Failed to peform linear regression")
-            rich.print(linreg_xs)
-            rich.print(linreg_ys)
+            # Identical results are left with no chunks, which sums to 0.
+            if expected.exactMatch(experiment):
+                continue
+            d1, d2 = expected.distributionMatrices(experiment)
+            if threshold is not None:
+                upper = expected.normalizeMetric(
+                    numpy.sum(graph.batch_normalized_dist_upper_bound(d1, d2)))
+                if upper <= threshold:
+                    bounded[index] = BoundedDistance(upper)
+                    continue
+            if cache is not None:
+                keys[index] = distcache.pair_key(d1, d2)
+                dists = cache.get(keys[index])
+                if dists is not None:
+                    parts[index].append(dists)
+                    continue
+        except CHECK_INFRASTRUCTURE_ERRORS:
+            raise
+        except Exception:
+            failed[index] = True
+            continue
+        for start in range(0, d1.shape[0], CHECK_CHUNK_SIZE):
+            tasks.append((d1[start:start + CHECK_CHUNK_SIZE],
+                          d2[start:start + CHECK_CHUNK_SIZE]))
+            owners.append(index)
+            remaining[index] += 1
+    chunk_counts = list(remaining)
+
+    def finish(index):
+        if failed[index]:
+            return None
+        if bounded[index] is not None:
+            return bounded[index]
+        dists = numpy.concatenate(parts[index]) if len(
+            parts[index]) > 0 else numpy.zeros(0)
+        if keys[index] is not None and chunk_counts[index] > 0:
+            cache.put(keys[index], dists)
+        return jobs[index][0].normalizeMetric(numpy.sum(dists))
+
+    next_job = 0
+    with multiprocessing.pool.Pool(procs) as pool:
+        for owner, dists in zip(owners, pool.imap(_node_distances, tasks)):
+            if dists is None:
+                failed[owner] = True
+            else:
+                parts[owner].append(dists)
+            remaining[owner] -= 1
+            while next_job < len(jobs) and remaining[next_job] == 0:
+                yield finish(next_job)
+                next_job += 1
+    while next_job < len(jobs):
+        yield finish(next_job)
+        next_job += 1
+
+
+def check_distances(jobs, procs=1, threshold=None):
+    if procs is None or procs == 1:
+        return _serial_distances(jobs, threshold)
+    return _parallel_distances(jobs, procs, threshold)
+
+
+def fail_fast_order(jobs, history, trial_digests):
+    # Trials that failed with a larger share of the binaries they were run
+    # with go first. A trial with no history counts as failing half of the
+    # time. Among equally fragile trials the cheapest go first, so that a
+    # broken binary shows as soon as possible.
+    def key(job):
+        expected, experiment = job
+        runs, failures = history.get(trial_digests.get(experiment), (0, 0))
+        return (-(failures + 1) / (runs + 2), expected.estimatedCost())
+
+    return sorted(jobs, key=key)
+
+
+def sample_jobs(jobs, count, seed=0):
+    # Picks count trials, spread over the taxa/regions combinations in
+    # proportion to their share of the archive, with at least one trial from
+    # each combination.
+    if count >= len(jobs):
+        return jobs
+    strata = {}
+    for job in jobs:
+        strata.setdefault(job[0].dimensions(), []).append(job)
+    keys = sorted(strata)
+    quotas = {k: count * len(strata[k]) / len(jobs) for k in keys}
+    take = {k: min(len(strata[k]), max(1, int(quotas[k]))) for k in keys}
+    for k in sorted(keys, key=lambda k: int(quotas[k]) - quotas[k]):
+        if sum(take.values()) >= count:
+            break
+        if take[k] < len(strata[k]):
+            take[k] += 1
+
+    rng = random.Random(seed)
+    chosen = set()
+    for k in keys:
+        chosen.update(id(job) for job in rng.sample(strata[k], take[k]))
+    return [job for job in jobs if id(job) in chosen]
+
+
+def parse_shard(text):
+    # Shards are written as i/N, counting from 1.
+    try:
+        shard, shards = [int(t) for t in text.split('/')]
+    except ValueError:
+        raise ValueError("Shards should be given as i/N, not {}".format(text))
+    if shards < 1 or shard < 1 or shard > shards:
+        raise ValueError("Shard {} is not between 1 and {}".format(
+            shard, shards))
+    return shard, shards
+
+
+def shard_jobs(jobs, shard, shards):
+    # Deals the trials out longest first, each to the shard with the least
+    # work so far. Every shard sees the same archive and computes the same
+    # split, so the shards cover the archive exactly once. Runtimes are only
+    # used when every trial has one, since they are not comparable with
+    # problem sizes.
+    costs = [job[0].estimatedCost() for job in jobs]
+    if all(cost[0] > 0.0 for cost in costs):
+        costs = [cost[0] for cost in costs]
+    else:
+        costs = [cost[1] for cost in costs]
+    order = sorted(range(len(jobs)),
+                   key=lambda index: (-costs[index], str(jobs[index][0])))
+    loads = [0.0 for _ in range(shards)]
+    chosen = set()
+    for index in order:
+        target = loads.index(min(loads))
+        loads[target] += costs[index]
+        if target == shard - 1:
+            chosen.add(index)
+    return [job for index, job in enumerate(jobs) if index in chosen]
+
+
+def regression_rsquared(xs, ys):
+    # R² of an ordinary least squares fit with an intercept, as
+    # scikit-learn's LinearRegression().fit(xs, ys).score(xs, ys) gives.
+    xs = numpy.asarray(xs, dtype=numpy.float64)
+    ys = numpy.asarray(ys, dtype=numpy.float64)
+    design = numpy.column_stack([xs, numpy.ones(len(ys))])
+    coefficients = numpy.linalg.lstsq(design, ys, rcond=None)[0]
+    ss_res = numpy.sum((ys - design @ coefficients)**2)
+    ss_tot = numpy.sum((ys - numpy.mean(ys))**2)
+    if ss_tot == 0.0:
+        return 1.0 if ss_res == 0.0 else 0.0
+    return float(1.0 - ss_res / ss_tot)
+
+
+def _fit_regression(console, linreg_xs, linreg_ys):
+    if len(linreg_xs) == 0:
+        return 0.0
+    try:
+        linreg_rsquared = regression_rsquared(linreg_xs, linreg_ys)
+        console.print("Parameter error regression coefficient: {}".format(
+            linreg_rsquared))
+        return linreg_rsquared
+    except:
+        rich.print("Failed to peform linear regression")
+        rich.print(linreg_xs)
+        rich.print(linreg_ys)
+        return 0.0
+
+
+def runtime_regressions(records, tolerance):
+    # Compares each trial's runtime with the baseline binary's runtime on the
+    # same trial. Buckets are scored with the geometric mean of the ratios,
+    # so that a few fast trials can not hide a slow one.
+    slow_runs = []
+    buckets = {}
+    for record in records:
+        runtime = record['runtime']
+        baseline = record['baseline-runtime']
+        if record['outcome'] not in SUCCESSFUL_OUTCOMES or runtime is None\
+                or baseline is None or baseline <= 0.0 or runtime <= 0.0:
+            continue
+        ratio = runtime / baseline
+        buckets.setdefault((record['taxa'], record['regions']),
+                           []).append(math.log(ratio))
+        if ratio > 1.0 + tolerance:
+            slow_runs.append(
+                directory.ExperimentWithSlowdown(
+                    directory.RecordedTrialDirectory(record['path']), ratio))
+    slowdowns = [{
+        'taxa': taxa,
+        'regions': regions,
+        'trials': len(buckets[(taxa, regions)]),
+        'slowdown': float(numpy.exp(numpy.mean(buckets[(taxa, regions)])))
+    } for taxa, regions in sorted(buckets)]
+    return slow_runs, slowdowns
+
+
+def _print_slowdowns(console, slow_runs, slowdowns, tolerance):
+    import rich.table
+    table = rich.table.Table(title="Runtime relative to the baseline")
+    for column in ['Taxa', 'Regions', 'Trials', 'Slowdown']:
+        table.add_column(column, justify='right')
+    for bucket in slowdowns:
+        style = 'red' if bucket['slowdown'] > 1.0 + tolerance else None
+        table.add_row(str(bucket['taxa']),
+                      str(bucket['regions']),
+                      str(bucket['trials']),
+                      "{:.3f}".format(bucket['slowdown']),
+                      style=style)
+    console.print(table)
+    if len(slow_runs) != 0:
+        console.print(
+            ("Tests that ran more than {:.0f}% slower than the baseline " +
+             "(top 10):").format(tolerance * 100),
+            sorted(slow_runs, key=lambda a: a._slowdown)[-10:])
+
+
+def report(console,
+           prefix,
+           failed_runs,
+           error_runs,
+           linreg_xs,
+           linreg_ys,
+           total_jobs,
+           records=None,
+           runtime_tolerance=0.2,
+           skipped_runs=None):
+    # yaml is only needed for the report, so it is not loaded at startup.
+    import yaml
+    linreg_rsquared = _fit_regression(console, linreg_xs, linreg_ys)
+
+    slow_runs, slowdowns = runtime_regressions(records or [],
+                                               runtime_tolerance)
+    results = {"failed-runs": failed_runs, "error-runs": error_runs}
+    if skipped_runs:
+        results["skipped-runs"] = skipped_runs
+    if len(slowdowns) != 0:
+        _print_slowdowns(console, slow_runs, slowdowns, runtime_tolerance)
+        results["slow-runs"] = slow_runs
+        results["slowdowns"] = slowdowns
 
     with open(os.path.join(prefix, "failed_paths.yaml"), "w") as outfile:
         yaml.add_representer(directory.ExpectedTrialDirectory,
                              directory.DirectoryRepresenter)
         yaml.add_representer(directory.ExperimentTrialDirectory,
                              directory.DirectoryRepresenter)
+        yaml.add_representer(directory.RecordedTrialDirectory,
+                             directory.DirectoryRepresenter)
         yaml.add_representer(directory.ExperimentWithDistance,
                              directory.ExperimentWithDistanceRepresenter)
-        outfile.write(
-            yaml.dump({
-                "failed-runs": failed_runs,
-                "error-runs": error_runs
-            }))
+        yaml.add_representer(directory.ExperimentWithSlowdown,
+                             directory.ExperimentWithSlowdownRepresenter)
+        outfile.write(yaml.dump(results))
 
     if len(failed_runs) != 0 or len(error_runs) != 0:
         if len(failed_runs) != 0:
@@ -100,23 +476,342 @@ def run(prefix, archive, program, prefix_specified, copy_threshold,
             console.print(
                 "Total of {} ({}%) jobs resulted in errors over tolerance".
                 format(len(failed_runs),
-                       len(failed_runs) / len(jobs) * 100))
+                       len(failed_runs) / total_jobs * 100))
         if len(error_runs) != 0:
             console.print("Tests that failed to complete:",
                           sorted(error_runs, key=lambda d: d._path))
             console.print("Total of {} ({}%) jobs failed to run".format(
                 len(error_runs),
-                len(error_runs) / len(jobs) * 100))
-        if not prefix_specified and (
-            (len(failed_runs) > copy_threshold and not linreg_rsquared > 0.95)
-                or len(error_runs) != 0):
-            basename = os.path.split(prefix)[1]
-            new_prefix = os.path.abspath(os.path.join(os.getcwd(), basename))
-            console.print(
-                "Copying the failed directories to {}".format(new_prefix))
-            shutil.copytree(prefix, new_prefix)
-
+                len(error_runs) / total_jobs * 100))
+        status = STATUS_FAILED
+    elif len(slow_runs) != 0:
+        console.print(
+            "[bold yellow]No wrong results, but {} ({}%) jobs ran slower "
+            "than the baseline".format(len(slow_runs),
+                                       len(slow_runs) / total_jobs * 100))
+        status = STATUS_SLOWER
     else:
         console.print("[bold green]All Clear!")
+        status = STATUS_PASSED
+    return linreg_rsquared, status
+
+
+def trial_runtime(experiment):
+    # The time lagrange reports for the analysis leaves out start up and
+    # file reading, so it is preferred over the time the process took.
+    runtime = experiment.runtime()
+    if runtime is None and experiment.usage() is not None:
+        runtime = experiment.usage().wall_time
+    return runtime
+
+
+def _partial_record(expected,
+                    experiment,
+                    outcome,
+                    dist=None,
+                    runtime=None,
+                    parameter_diff=None,
+                    baseline=None):
+    usage = experiment.usage()
+    taxa, regions = expected.dimensions()
+    return {
+        'path': experiment._path,
+        'taxa': taxa,
+        'regions': regions,
+        'outcome': outcome,
+        'distance': None if dist is None else float(dist),
+        'runtime': runtime,
+        'baseline-runtime': baseline,
+        'parameter-diff': None
+        if parameter_diff is None else [float(p) for p in parameter_diff],
+        'usage': None if usage is None else usage.as_dict(),
+    }
+
+
+def write_partial_results(prefix, records, shard=None, shards=None):
+    with open(os.path.join(prefix, PARTIAL_RESULTS_FILENAME), 'w') as outfile:
+        json.dump({
+            'shard': shard,
+            'shards': shards,
+            'trials': records
+        }, outfile)
+
+
+def merge(partial_paths, prefix, distance_threshold, runtime_tolerance=0.2):
+    start = timer()
+    console = rich.console.Console()
+    partials = []
+    for path in partial_paths:
+        if os.path.isdir(path):
+            path = os.path.join(path, PARTIAL_RESULTS_FILENAME)
+        with open(path) as infile:
+            partials.append(json.load(infile))
+
+    shards = set(p['shards'] for p in partials if p['shards'] is not None)
+    if len(shards) > 1:
+        raise RuntimeError("The partial results come from different shard " +
+                           "counts: {}".format(sorted(shards)))
+    if len(shards) == 1:
+        shard_count = shards.pop()
+        seen = [p['shard'] for p in partials]
+        missing = sorted(set(range(1, shard_count + 1)) - set(seen))
+        if len(missing) != 0 or len(seen) != len(set(seen)):
+            raise RuntimeError(
+                "Expected each of the {} shards once, missing {}".format(
+                    shard_count, missing))
+
+    failed_runs = []
+    error_runs = []
+    linreg_xs = []
+    linreg_ys = []
+    records = []
+    for partial in partials:
+        for record in partial['trials']:
+            records.append(record)
+            experiment = directory.RecordedTrialDirectory(record['path'])
+            if record['outcome'] in ERROR_OUTCOMES:
+                error_runs.append(experiment)
+            elif record['outcome'] == resultstore.OUTCOME_COMPLETED:
+                if record['parameter-diff'] is not None:
+                    linreg_xs.append(record['parameter-diff'])
+                    linreg_ys.append(record['distance'])
+                if record['distance'] > distance_threshold:
+                    failed_runs.append(
+                        directory.ExperimentWithDistance(
+                            experiment, record['distance']))
+
+    os.makedirs(prefix, exist_ok=True)
+    linreg_rsquared, status = report(console, prefix, failed_runs,
+                                     error_runs, linreg_xs, linreg_ys,
+                                     max(len(records), 1), records,
+                                     runtime_tolerance)
+    end = timer()
+    console.print("Merging took {:.3f} seconds".format(end - start))
+    return status
+
+
+def run(prefix, archive, program, prefix_specified, copy_threshold,
+        distance_threshold, *, check_procs=1, bound_check=False, procs=1,
+        archive_cache=None, result_store=None, incremental=False,
+        sample=None, sample_seed=0, shard=None, shards=None, timeout=None,
+        memory_limit=None, baseline=None, runtime_tolerance=0.2,
+        fail_fast=False, keep_passing=0):
+    start = timer()
+    failed_runs = []
+    error_runs = []
+    lagrange_runner = lagrange.lagrange(program, timeout, memory_limit)
+
+    binary_digest = None
+    trial_digests = {}
+    reused = []
+    if result_store is not None:
+        binary_digest = resultstore.file_digest(program)
+
+    def baseline_runtime(trial):
+        if baseline is None or result_store is None or trial is None:
+            return None
+        record = result_store.get(baseline, trial)
+        if record is None or record[0] not in SUCCESSFUL_OUTCOMES:
+            return None
+        return record[2]
+
+    def select_jobs(job_stream):
+        # Trials that already have a stored result for this binary are not
+        # run again in incremental mode. The expected results are part of the
+        # key, since the verdict depends on them as much as on the inputs.
+        for expected, experiment in job_stream:
+            if result_store is not None:
+                trial = resultstore.trial_digest(experiment.inputFiles() +
+                                                 expected.resultFiles())
+                trial_digests[experiment] = trial
+                record = result_store.get(binary_digest, trial)
+                if incremental and resultstore.reusable(
+                        record, distance_threshold):
+                    reused.append((expected, experiment, record))
+                    continue
+            yield expected, experiment
+
+    console = rich.console.Console()
+    linreg_xs = []
+    linreg_ys = []
+
+    with rich.progress.Progress() as progress:
+        extract_task = progress.add_task("[red]Extracting...", total=None)
+        work_task = progress.add_task("[red]Running...", total=0)
+        if trialarchive.is_trial_archive(archive):
+            # The index has what sampling and sharding need, so only the
+            # chosen trials are extracted.
+            selected = [(trial, None)
+                        for trial in trialarchive.read_index(archive)]
+            if sample is not None:
+                selected = sample_jobs(selected, sample, sample_seed)
+            if shards is not None:
+                selected = shard_jobs(selected, shard, shards)
+            job_stream = directory.extractTrialArchiveAndMakeDirectories(
+                archive, prefix, [trial for trial, _ in selected])
+        else:
+            if archive_cache is not None:
+                job_stream = archive_cache.jobs(archive, prefix)
+            else:
+                job_stream = directory.streamTarFileAndMakeDirectories(
+                    archive, prefix)
+            if sample is not None:
+                job_stream = sample_jobs(list(job_stream), sample,
+                                         sample_seed)
+            if shards is not None:
+                job_stream = shard_jobs(list(job_stream), shard, shards)
+
+        bound_threshold = distance_threshold if bound_check else None
+        records = []
+        partial_records = []
+
+        def record_result(expected, experiment, dist):
+            trial = trial_digests.get(experiment)
+            runtime = None
+            parameter_diff = None
+            if experiment.failed():
+                if experiment.timedOut():
+                    rich.print("Exp {} timed out".format(experiment))
+                    outcome = resultstore.OUTCOME_TIMEOUT
+                elif experiment.killed():
+                    rich.print("Exp {} was killed by signal {}".format(
+                        experiment, -experiment.usage().returncode))
+                    outcome = resultstore.OUTCOME_KILLED
+                else:
+                    rich.print("Exp {} failed".format(experiment))
+                    outcome = resultstore.OUTCOME_ERROR
+            elif isinstance(dist, BoundedDistance):
+                outcome = resultstore.OUTCOME_BOUNDED
+                dist = dist._upper
+                runtime = trial_runtime(experiment)
+            else:
+                runtime = trial_runtime(experiment)
+                parameter_diff = expected.parameterVectorDifference(experiment)
+                if dist is None:
+                    rich.print("Exp {} failed".format(experiment))
+                    experiment.setFailed()
+                    outcome = resultstore.OUTCOME_UNCHECKED
+                else:
+                    outcome = resultstore.OUTCOME_COMPLETED
+                    linreg_xs.append(parameter_diff)
+                    linreg_ys.append(dist)
+                    if dist > distance_threshold:
+                        failed_runs.append(
+                            directory.ExperimentWithDistance(experiment, dist))
+
+            records.append((trial, outcome, dist, runtime))
+            partial_records.append(
+                _partial_record(expected, experiment, outcome, dist, runtime,
+                                parameter_diff, baseline_runtime(trial)))
+            return resultstore.failed(outcome, dist, distance_threshold)
+
+        skipped_runs = []
+        if not fail_fast:
+            jobs, error_runs = run_experiments(select_jobs(job_stream),
+                                               lagrange_runner, procs,
+                                               progress, extract_task,
+                                               work_task)
+            progress.update(extract_task, total=len(jobs), visible=False)
+
+            random.Random(SHUFFLE_SEED).shuffle(jobs)
+
+            check_task = progress.add_task("[red]Checking...",
+                                           total=len(jobs))
+            for (expected, experiment), dist in zip(
+                    jobs, check_distances(jobs, check_procs,
+                                          bound_threshold)):
+                record_result(expected, experiment, dist)
+                progress.update(check_task, advance=1.0)
+        else:
+            # The whole archive is extracted first, so that the trials that
+            # failed most often in the past can be run first.
+            history = {}
+            if result_store is not None:
+                history = result_store.failure_history(distance_threshold)
+            selected = fail_fast_order(list(select_jobs(job_stream)),
+                                       history, trial_digests)
+            progress.update(extract_task,
+                            total=len(selected),
+                            completed=len(selected),
+                            visible=False)
+            check_task = progress.add_task("[red]Checking...",
+                                           total=len(selected))
+            failures = sum(
+                resultstore.failed(outcome, dist, distance_threshold)
+                for expected, experiment, (outcome, dist, runtime) in reused)
+            check_lock = threading.Lock()
+
+            def check_finished(expected, experiment):
+                nonlocal failures
+                dist = next(
+                    _serial_distances([(expected, experiment)],
+                                      bound_threshold))
+                with check_lock:
+                    if record_result(expected, experiment, dist):
+                        failures += 1
+                    progress.update(check_task, advance=1.0)
+                    return failures > copy_threshold
+
+            jobs, error_runs = [], []
+            if failures <= copy_threshold:
+                jobs, error_runs = run_experiments(selected, lagrange_runner,
+                                                   procs, progress,
+                                                   extract_task, work_task,
+                                                   in_order, check_finished)
+            ran = set(experiment for expected, experiment in jobs)
+            skipped_runs = [
+                experiment for expected, experiment in selected
+                if experiment not in ran
+            ]
+            if len(skipped_runs) != 0:
+                console.print(
+                    "[red bold]Stopped after {} failures, {} trials were not "
+                    "run".format(failures, len(skipped_runs)))
+
+    if result_store is not None:
+        result_store.put_many(binary_digest, records)
+
+    # Stored results are reported as if the trials had run, but they are
+    # left out of the parameter error regression.
+    for expected, experiment, (outcome, dist, runtime) in reused:
+        partial_records.append(
+            _partial_record(expected, experiment, outcome, dist, runtime,
+                            baseline=baseline_runtime(
+                                trial_digests[experiment])))
+        if outcome in ERROR_OUTCOMES:
+            error_runs.append(experiment)
+        elif outcome == resultstore.OUTCOME_UNCHECKED:
+            rich.print("Exp {} failed".format(experiment))
+        elif outcome == resultstore.OUTCOME_COMPLETED and\
+                dist > distance_threshold:
+            failed_runs.append(
+                directory.ExperimentWithDistance(experiment, dist))
+    if len(reused) > 0:
+        console.print("Reused {} stored results, ran {} trials".format(
+            len(reused), len(jobs)))
+    total_jobs = len(jobs) + len(reused)
+
+    write_partial_results(prefix, partial_records, shard, shards)
+    linreg_rsquared, status = report(console, prefix, failed_runs,
+                                     error_runs, linreg_xs, linreg_ys,
+                                     max(total_jobs, 1), partial_records,
+                                     runtime_tolerance, skipped_runs)
+
+    if not prefix_specified and (
+        (len(failed_runs) > copy_threshold and not linreg_rsquared > 0.95)
+            or len(error_runs) != 0):
+        # Only the failing trials are kept, since the prefix is removed.
+        basename = os.path.split(prefix)[1]
+        bundle_path = os.path.abspath(
+            os.path.join(os.getcwd(), basename + retention.BUNDLE_SUFFIX))
+        failing, passing = retention.write_bundle(
+            bundle_path, prefix, partial_records, distance_threshold,
+            ["failed_paths.yaml", PARTIAL_RESULTS_FILENAME], keep_passing,
+            SHUFFLE_SEED)
+        console.print(
+            "Saved {} failing and {} passing trials to {}".format(
+                failing, passing, bundle_path))
+
     end = timer()
     console.print("Testing took {:.3f} seconds".format(end - start))
+    return status
@@ -0,0 +1,124 @@
+import json
+import os
+import zipfile
+
+# A trial archive is a zip file, so every file is compressed on its own and
+# can be read without decompressing the rest. The index lists the trials,
+# their files, and what is needed to sample and shard them, so a run can
+# pick its trials before extracting anything.
+INDEX_FILENAME = 'index.json'
+ARCHIVE_FORMAT_VERSION = 1
+TRIAL_FILE_EXTENSIONS = ['.conf', '.nwk', '.phy', '.log', '.tre']
+RESULTS_SUFFIX = '.results.json'
+
+
+def is_trial_archive(path):
+    return zipfile.is_zipfile(path)
+
+
+def trial_files(trial_path):
+    # The lagrange inputs, and the log and results of the reference run.
+    # Anything else in the directory, such as usage records, is left out.
+    return sorted(
+        f for f in os.listdir(trial_path)
+        if os.path.isfile(os.path.join(trial_path, f)) and (
+            os.path.splitext(f)[1] in TRIAL_FILE_EXTENSIONS
+            or f.endswith(RESULTS_SUFFIX)))
+
+
+class archived_trial:
+    # An entry of the index. It has the dimensions and estimatedCost of the
+    # expected results directory it will become, so the tester can sample
+    # and shard the trials before they are extracted.
+    def __init__(self, entry):
+        self._entry = entry
+
+    @property
+    def path(self):
+        return self._entry['path']
+
+    @property
+    def files(self):
+        return self._entry['files']
+
+    def dimensions(self):
+        return (self._entry['taxa'], self._entry['regions'])
+
+    def estimatedCost(self):
+        runtime = self._entry['runtime']
+        return (runtime if runtime is not None else 0.0,
+                self._entry['taxa'] * 2**self._entry['regions'])
+
+    def as_dict(self):
+        return dict(self._entry)
+
+    def __repr__(self):
+        return self.path
+
+
+class writer:
+    def __init__(self, path):
+        self._path = os.path.abspath(path)
+        self._staging_path = self._path + '.partial'
+        self._zip = zipfile.ZipFile(self._staging_path, 'w',
+                                    zipfile.ZIP_DEFLATED)
+        self._trials = []
+
+    def add(self, trial, trial_path, taxa, regions, runtime=None):
+        files = trial_files(trial_path)
+        for f in files:
+            self._zip.write(os.path.join(trial_path, f),
+                            arcname='/'.join([trial, f]))
+        self._trials.append(
+            archived_trial({
+                'path': trial,
+                'files': files,
+                'taxa': taxa,
+                'regions': regions,
+                'runtime': runtime,
+            }))
+
+    def close(self):
+        self._zip.writestr(
+            INDEX_FILENAME,
+            json.dumps({
+                'version': ARCHIVE_FORMAT_VERSION,
+                'trials': [t.as_dict() for t in self._trials],
+            }))
+        self._zip.close()
+        os.replace(self._staging_path, self._path)
+
+    def abort(self):
+        self._zip.close()
+        os.remove(self._staging_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def read_index(path):
+    with zipfile.ZipFile(path) as archive:
+        index = json.loads(archive.read(INDEX_FILENAME))
+    if index['version'] != ARCHIVE_FORMAT_VERSION:
+        raise RuntimeError(
+            "Trial archive {} has format version {}, expected {}".format(
+                path, index['version'], ARCHIVE_FORMAT_VERSION))
+    return [archived_trial(entry) for entry in index['trials']]
+
+
+def extract_trials(path, destination_path, trials=None):
+    # Extracts the given trials, or all of them, one at a time, and yields
+    # the directory of each once its files are in place.
+    if trials is None:
+        trials = read_index(path)
+    with zipfile.ZipFile(path) as archive:
+        for trial in trials:
+            for f in trial.files:
+                archive.extract('/'.join([trial.path, f]), destination_path)
+            yield os.path.join(destination_path, trial.path)
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import rich
+import rich.table
+
+ROOT_DIR = os.path.abspath(
+    os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+CLI_DIRS = {
+    'tester': os.path.join(ROOT_DIR, 'tester', 'src'),
+    'profiler': os.path.join(ROOT_DIR, 'profiler', 'src'),
+    'distance': os.path.join(ROOT_DIR, 'distance', 'src'),
+}
+# None of these should be loaded just to start a CLI. They are imported in
+# the code paths that use them.
+HEAVY_MODULES = [
+    'sklearn', 'matplotlib', 'pandas', 'seaborn', 'ete3', 'git',
+    'scipy.stats', 'scipy.optimize'
+]
+# Runs 'main.py --help', which has to parse the arguments but does no work.
+PROBE = """
+import contextlib, io, json, runpy, sys, time
+sys.argv = ['main.py', '--help']
+start = time.perf_counter()
+with contextlib.redirect_stdout(io.StringIO()):
+    try:
+        runpy.run_path('main.py', run_name='__main__')
+    except SystemExit:
+        pass
+elapsed = time.perf_counter() - start
+print(json.dumps({{
+    'time': elapsed,
+    'heavy': [m for m in {heavy!r} if m in sys.modules],
+}}))
+"""
+
+
+def probe(cli_dir):
+    # Each probe runs in a fresh interpreter, so nothing is cached in
+    # sys.modules from an earlier import.
+    ret = subprocess.run(
+        [sys.executable, '-c',
+         PROBE.format(heavy=HEAVY_MODULES)],
+        cwd=cli_dir,
+        capture_output=True,
+        text=True,
+        env=dict(os.environ, PYTHONPATH=cli_dir, PYTHONDONTWRITEBYTECODE='1'))
+    if ret.returncode != 0:
+        raise RuntimeError("Starting {} failed:\n{}".format(
+            cli_dir, ret.stderr))
+    return json.loads(ret.stdout.splitlines()[-1])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Check how long each CLI takes to start, and that no ' +
+        'heavy dependency is loaded before it needs it')
+    parser.add_argument('--cli',
+                        nargs='+',
+                        choices=sorted(CLI_DIRS),
+                        default=sorted(CLI_DIRS))
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--budget',
+                        type=float,
+                        default=1.0,
+                        help='Largest acceptable startup time in seconds')
+    args = parser.parse_args()
+
+    table = rich.table.Table(title="CLI startup time")
+    for column in ['CLI', 'Best (s)', 'Worst (s)', 'Heavy modules']:
+        table.add_column(column)
+
+    failed = False
+    for cli in args.cli:
+        probes = [probe(CLI_DIRS[cli]) for _ in range(args.repeat)]
+        times = [p['time'] for p in probes]
+        heavy = sorted(set(m for p in probes for m in p['heavy']))
+        style = None
+        if min(times) > args.budget or len(heavy) != 0:
+            failed = True
+            style = 'red'
+        table.add_row(cli,
+                      "{:.3f}".format(min(times)),
+                      "{:.3f}".format(max(times)),
+                      ', '.join(heavy),
+                      style=style)
+
+    rich.print(table)
+    if failed:
+        rich.print("[red bold]Startup is over budget, or a heavy module " +
+                   "is loaded at startup[/red bold]")
+        sys.exit(1)